@@ -1,32 +1,121 @@
 # Script to test overhead of QTLab framework
+#
+# Run headless from the QTLab directory with
+#
+#   python examples/test_speed.py
+#
+# or inside QTLab using "execfile('examples/test_speed.py')". Only dummy
+# instruments are used, so no hardware is needed. Results are written to the
+# file in QTLAB_BENCHMARK_OUTPUT (default benchmark.json); to look for
+# regressions compare two result files with:
+#
+#   python source/lib/benchmark.py old.json new.json
 
+import os
+import sys
+
+outfile = os.path.abspath(os.environ.get('QTLAB_BENCHMARK_OUTPUT',
+        'benchmark.json'))
+
+if 'qt' not in sys.modules:
+    # Not started inside QTLab, set up configuration without GUI
+    _basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    os.chdir(_basedir)
+    sys.path.insert(0, os.path.join(_basedir, 'source'))
+    from lib import config as _config
+    _cfg = _config.create_config('qtlab.cfg')
+    _cfg.load_userconfig()
+    _cfg.setup_tempdir()
+    _cfg['startgui'] = False
+
+import gobject
+import numpy
 import qt
-import time
-
-ins = qt.instruments['dsgen']
-N = 1e6
-
-start = time.time()
-i = 0
-while i < N:
-    v = ins._ins.do_get_wave()
-    i += 1
-stop = time.time()
-print 'do_get_wave: %s sec' % (stop - start, )
-
-start = time.time()
-i = 0
-while i < N:
-    v = ins.get_wave(fast=True)
-    i += 1
-stop = time.time()
-print 'get_wave(fast=True): %s sec' % (stop - start, )
-
-start = time.time()
-i = 0
-while i < N:
-    v = ins.get_wave()
-    i += 1
-stop = time.time()
-print 'get_wave: %s sec' % (stop - start, )
+from lib import benchmark
+from lib.network import objsh_bench
+
+suite = benchmark.BenchmarkSuite()
+
+def process_events():
+    '''Handle pending events, works with and without the GTK main loop.'''
+    ctx = gobject.main_context_default()
+    while ctx.pending():
+        ctx.iteration(False)
+
+def add_points(d, n=1000):
+    for i in xrange(n):
+        d.add_data_point(i, 0.5 * i)
+
+def new_data(name, **kwargs):
+    d = qt.Data(name=name, **kwargs)
+    d.add_coordinate('x')
+    d.add_value('y')
+    return d
+
+dsgen = qt.instruments.create('bench_dsgen', 'dummy_signal_generator')
+rawins = qt.instruments.get('bench_dsgen', proxy=False)
+
+try:
+
+    # Instrument get/set
+
+    suite.run('ins.do_get_wave', rawins.do_get_wave)
+    suite.run('ins.get_wave(fast=True)', lambda: rawins.get_wave(fast=True))
+    suite.run('ins.get_wave', lambda: rawins.get_wave())
+    suite.run('ins.get(wave)', lambda: rawins.get('wave'))
+    suite.run('ins.get(wave, query=False)',
+            lambda: rawins.get('wave', query=False))
+    suite.run('ins.set_amplitude(fast=True)',
+            lambda: rawins.set_amplitude(1.0, fast=True))
+    suite.run('ins.set_amplitude', lambda: rawins.set_amplitude(1.0))
+
+    # Calls through insproxy.Proxy
+
+    suite.run('proxy.get_wave(fast=True)', lambda: dsgen.get_wave(fast=True))
+    suite.run('proxy.get_wave', lambda: dsgen.get_wave())
+    suite.run('proxy.set_amplitude', lambda: dsgen.set_amplitude(1.0))
+
+    # Process pending 'changed' signals before continuing
+    process_events()
+
+    # Remote calls through object_sharer, against a server subprocess
+
+    try:
+        objsh_bench.run(suite=suite)
+    except Exception, e:
+        suite.skip('objsh', str(e))
+
+    # Data; every call uses a new Data object, so that the time per point
+    # does not depend on the number of calls.
+
+    suite.run('data.add_data_point(inmem) x1000',
+            lambda: add_points(new_data('bench_inmem', inmem=True,
+                infile=False)))
+
+    fn = os.path.join(qt.config['tempdir'], 'bench_infile.dat')
+    def add_points_infile():
+        d = new_data('bench_infile', inmem=False, infile=True)
+        d.create_file(filepath=fn, settings_file=False)
+        add_points(d)
+        d.close_file()
+    suite.run('data.add_data_point(infile) x1000', add_points_infile)
+
+    suite.run('data.load', lambda: qt.Data(fn, name='bench_load'), n=10)
+
+    # Plot command generation; needs gnuplot
+
+    x = numpy.arange(1000)
+    d = qt.Data(data=numpy.column_stack((x, 0.5 * x)), name='bench_plot',
+            tempfile=True)
+    try:
+        p = qt.Plot2D(d, name='bench_plot', update=False)
+        suite.run('plot.create_plot_command', p.create_plot_command)
+        suite.run('plot.get_commands', p.get_commands)
+    except Exception, e:
+        suite.skip('plot.create_plot_command', str(e))
+
+    suite.save(outfile)
+    print 'Results written to %s' % outfile
 
+finally:
+    rawins.remove()
@@ -0,0 +1,47 @@
+# Check that drivers work with the simulated VISA provider
+#
+# Run headless from the QTLab directory with
+#
+#   python examples/test_visa_sim.py
+#
+# or inside QTLab using "execfile('examples/test_visa_sim.py')". A
+# Keithley_2000 is created through qt.instruments with visa='sim' and read
+# out; no hardware is needed.
+
+import os
+import sys
+
+if 'qt' not in sys.modules:
+    # Not started inside QTLab, set up configuration without GUI
+    _basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    os.chdir(_basedir)
+    sys.path.insert(0, os.path.join(_basedir, 'source'))
+    from lib import config as _config
+    _cfg = _config.create_config('qtlab.cfg')
+    _cfg.load_userconfig()
+    _cfg.setup_tempdir()
+    _cfg['startgui'] = False
+
+import qt
+import instrument
+import visa_sim
+
+visa_sim.add_device('GPIB::16', 'Keithley_2000')
+dmm = qt.instruments.create('sim_dmm', 'Keithley_2000', address='GPIB::16',
+        visa='sim')
+rawins = qt.instruments.get('sim_dmm', proxy=False)
+
+try:
+    if rawins is None or isinstance(rawins, instrument.InvalidInstrument):
+        raise RuntimeError('Unable to create Keithley_2000 with visa=sim')
+
+    val = dmm.get_readnextval()
+    if val is None or abs(val - 1.0) > 0.01:
+        raise RuntimeError('Unexpected reading from simulated device: %r' % \
+                (val, ))
+    print 'Keithley_2000 with visa=sim: OK, reading %s' % (val, )
+
+finally:
+    if rawins is not None:
+        rawins.remove()
+    visa_sim.remove_device('GPIB::16')
@@ -1,11 +1,14 @@
 from lib.network import object_sharer
-from lib import temp, lockfile
+from lib import temp, lockfile, calltimer
+from lib.persist import get_persist_store
 
+qt.flow.register_exit_handler(get_persist_store().flush)
 qt.flow.register_exit_handler(qt.config._do_save)
 qt.flow.register_exit_handler(qt.flow.close_gui)
 qt.flow.register_exit_handler(object_sharer.helper.close_sockets)
 qt.flow.register_exit_handler(temp.File.remove_all)
 qt.flow.register_exit_handler(lockfile.remove_lockfile)
+qt.flow.register_exit_handler(calltimer.get_worker_pool().shutdown)
 
 # Clear "starting" status
 qt.flow.finished_starting()
@@ -21,7 +21,6 @@ import visa
 import types
 import logging
 from time import sleep
-import struct
 import numpy
 
 import qt
@@ -196,11 +195,12 @@ class HP_8753C(Instrument):
             None
 
         Output:
-            data (int)  : list of data points
+            data (numpy array)  : data points
         '''
-        data = self._visainstrument.ask('FORM2;DISPDATA;OUTPFORM;')
-        d = [struct.unpack('>f', data[i:i+4])[0] for i in range(4, len(data),8)]
-        return d
+        # FORM2 gives (real, imaginary) pairs of big endian floats
+        data = visa.read_block(self._visainstrument,
+                'FORM2;DISPDATA;OUTPFORM;', dtype='>f4')
+        return data[0::2]
 
 ### Functions for doing measurements
 
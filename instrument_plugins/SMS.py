@@ -26,6 +26,7 @@
 from instrument import Instrument
 import types
 import pyvisa.vpp43 as vpp43
+from lib import visafunc
 from time import sleep
 import logging
 import pickle
@@ -39,14 +40,15 @@ class SMS(Instrument):
     Usage:
     Initialize with
     <name> = instruments.create('<name>', 'SMS', address='<ASRL address>',
-        reset=<bool>, numdacs=<multiple of 4>)
+        reset=<bool>, numdacs=<multiple of 4>, write_delay=<seconds>)
 
-    The last two parameters are optional. Delfaults are
-    reset=False, numdacs=8
+    The last three parameters are optional. Delfaults are
+    reset=False, numdacs=8, write_delay=0.05
     When reset=False make sure the specified parameterfile exists
    '''
 
-    def __init__(self, name, address, reset=False, numdacs=8):
+    def __init__(self, name, address, reset=False, numdacs=8,
+            write_delay=0.05):
         '''
         Initializes the SMS, and communicates with the wrapper
         Dacvalues are stored  in "'SMS_' + address + '.dat'" ??really??
@@ -56,6 +58,8 @@ class SMS(Instrument):
             address (string)     : ASRL address
             reset (bool)         : resets to default values, default=false
             numdacs (int)        : number of dacs, multiple of 4, default=8
+            write_delay (float)  : time to wait after each write in
+                                   seconds, default=0.05
 
         Output:
             None
@@ -104,6 +108,10 @@ class SMS(Instrument):
                 flags=Instrument.FLAG_GET, units='Volts')
         self.add_parameter('battvoltage_neg', type=types.FloatType,
                 flags=Instrument.FLAG_GET, units='Volts')
+        self.add_parameter('write_delay', type=types.FloatType,
+                flags=Instrument.FLAG_SET | Instrument.FLAG_SOFTGET,
+                minval=0, units='s')
+        self.set_write_delay(write_delay)
 
         self._open_serial_connection()
 
@@ -154,6 +162,12 @@ class SMS(Instrument):
         vpp43.set_attribute(self._vi, vpp43.VI_ATTR_ASRL_END_IN,
             vpp43.VI_ASRL_END_NONE)
 
+        # Polarity replies have a fixed length, e.g. '-2V ... +2V', so
+        # reading can stop as soon as they have arrived
+        self._last_command = None
+        for j in range(self._numdacs/4):
+            visafunc.register_reply_length(self._vi, 'POLD%d;' % (j+1), 11)
+
     # close serial connection
     def _close_serial_connection(self):
         '''
@@ -376,6 +390,19 @@ class SMS(Instrument):
         reply = float(self._read_buffer())
         return reply
 
+    def do_set_write_delay(self, delay):
+        '''
+        Sets the time to wait after each write, to give the SMS time to
+        process the command
+
+        Input:
+            delay (float) : delay in seconds
+
+        Output:
+            None
+        '''
+        self._write_delay = delay
+
     #  Retrieving data from buffer
     def _read_buffer(self):
         '''
@@ -388,9 +415,8 @@ class SMS(Instrument):
             buffer (string) : data in buffer
         '''
         logging.debug(__name__ + ' : Reading buffer')
-        tekst = vpp43.read(self._vi,vpp43.get_attribute(self._vi,
-            vpp43.VI_ATTR_ASRL_AVAIL_NUM))
-        sleep(0.05)
+        tekst = visafunc.read_reply(self._vi, self._last_command,
+            timeout=0.5)
 
         if (tekst==''):
             return tekst
@@ -414,14 +440,14 @@ class SMS(Instrument):
         logging.debug(__name__ + ' : Start running _write_to_instrument with:' + tekst)
         # clear buffer
         logging.debug(__name__ + ' : clearing buffer')
-        restbuffer = self._read_buffer()
-        sleep(0.05)
+        restbuffer = visafunc.read_all(self._vi)
         if (restbuffer!=''):
             logging.error(__name__ + ' : Buffer contained unread data : ' +
                 restbuffer)
         logging.debug(__name__ + ' : writing to vpp43')
         vpp43.write(self._vi, tekst)
-        sleep(0.05)
+        self._last_command = tekst
+        sleep(self._write_delay)
 
     # Save data
     def _load_values_from_file(self):
@@ -43,6 +43,9 @@ class Tektronix_AWG5014(Instrument):
     4) Add 4-channel compatibility
     '''
 
+    # Waveform file records: float value and marker bits (little endian)
+    WFM_DTYPE = numpy.dtype([('w', '<f4'), ('m', 'u1')])
+
     def __init__(self, name, address, reset=False, clock=1e9, numpoints=1000):
         '''
         Initializes the AWG520.
@@ -188,10 +191,11 @@ class Tektronix_AWG5014(Instrument):
             None
         '''
         logging.debug(__name__ + ' : Clear waveforms from channels')
-        self._visainstrument.write('SOUR1:FUNC:USER ""')
-        self._visainstrument.write('SOUR2:FUNC:USER ""')
-        self._visainstrument.write('SOUR3:FUNC:USER ""')
-        self._visainstrument.write('SOUR4:FUNC:USER ""')
+        with self.batch():
+            self._visainstrument.write('SOUR1:FUNC:USER ""')
+            self._visainstrument.write('SOUR2:FUNC:USER ""')
+            self._visainstrument.write('SOUR3:FUNC:USER ""')
+            self._visainstrument.write('SOUR4:FUNC:USER ""')
 
     def run(self):
         '''
@@ -661,32 +665,17 @@ class Tektronix_AWG5014(Instrument):
                 elif bool:
                     bestand = bestand + lijst[i]
         if exists:
-            data = self._visainstrument.ask('MMEM:DATA? "%s"' % name)
+            data = visa.read_block(self._visainstrument,
+                    'MMEM:DATA? "%s"' % name).tostring()
             logging.debug(__name__  + ' : File exists on instrument, loading \
             into local memory')
-            # string alsvolgt opgebouwd: '#' <lenlen1> <len> 'MAGIC 1000\r\n' '#' <len waveform> 'CLOCK ' <clockvalue>
-            len1=int(data[1])
-            len2=int(data[2:2+len1])
-            i=len1
-            tekst = ""
-            while (tekst!='#'):
-                tekst=data[i]
-                i=i+1
-            len3=int(data[i])
-            len4=int(data[i+1:i+1+len3])
-
-            w=[]
-            m1=[]
-            m2=[]
-
-            for q in range(i+1+len3, i+1+len3+len4,5):
-                j=int(q)
-                c,d = struct.unpack('<fB', data[j:5+j])
-                w.append(c)
-                m2.append(int(d/2))
-                m1.append(d-2*int(d/2))
-
-            clock = float(data[i+1+len3+len4+5:len(data)])
+            # file consists of 'MAGIC 1000\r\n' '#' <lenlen> <len> <waveform> 'CLOCK ' <clockvalue>
+            wfm, i = visa.parse_block(data, self.WFM_DTYPE, data.index('#'))
+            w = wfm['w'].astype(float)
+            m1 = wfm['m'] & 1
+            m2 = wfm['m'] >> 1
+
+            clock = float(data[i+5:])
 
             self._values['files'][name]={}
             self._values['files'][name]['w']=w
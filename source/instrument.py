@@ -23,15 +23,27 @@ import math
 import inspect
 from gettext import gettext as _L
 from lib import calltimer
+from lib import busarbiter
+from lib.scheduler import get_probe_scheduler
+from lib.iostats import IOStats
 from lib.network.object_sharer import SharedGObject, cache_result
 
 import numpy as np
 import logging
 import qt
+import visa
 
 from lib.config import get_config
+from lib.misc import exact_time
 config = get_config()
 
+from lib.persist import get_persist_store
+persist = get_persist_store()
+
+# Signals that clear results cached by remote proxies
+_INTROSPECTION_SIGNALS = ('parameter-added', 'parameter-removed', 'reload')
+_PARAMETER_SIGNALS = _INTROSPECTION_SIGNALS + ('parameter-changed', 'changed')
+
 class Instrument(SharedGObject):
     """
     Base class for instruments.
@@ -80,6 +92,12 @@ class Instrument(SharedGObject):
                                 # try to read again for a new instance
 
     USE_ACCESS_LOCK = False     # For now
+    USE_BUS_ARBITER = True      # Prioritize access to shared buses
+    COLLECT_IO_STATS = True     # Record timing of get/set functions
+
+    # SCPI settings, used by batch()
+    SCPI_INPUT_BUFFER = 1024    # Max length of a combined message
+    SCPI_ERROR_QUERY = 'SYST:ERR?'  # Query to read one entry of error queue
 
     RESERVED_NAMES = ('name', 'type')
 
@@ -94,6 +112,10 @@ class Instrument(SharedGObject):
 
         self._changed = {}
         self._changed_hid = None
+        self._changed_interval = config.get('changed_interval', 0)
+        self._changed_last_emit = None
+        self._changed_stats = {}
+        self.reset_changed_statistics()
 
         self._options = kwargs
         if 'tags' not in self._options:
@@ -103,7 +125,8 @@ class Instrument(SharedGObject):
         self._parameter_groups = {}
         self._functions = {}
         self._added_methods = []
-        self._probe_ids = []
+
+        self._io_stats = IOStats()
 
         self._default_read_var = None
         self._default_write_var = None
@@ -115,6 +138,9 @@ class Instrument(SharedGObject):
             self._access_lock = calltimer.TimedLock(2.0)
             self._lock_classes[self._lock_class] = self._access_lock
 
+        self._bus = busarbiter.get_bus_arbiter(
+                kwargs.get('bus', self._lock_class))
+
     def __str__(self):
         return "Instrument '%s'" % (self.get_name())
 
@@ -129,6 +155,7 @@ class Instrument(SharedGObject):
 
         return self._name
 
+    @cache_result(invalidate=_INTROSPECTION_SIGNALS)
     def get_type(self):
         """Return type of instrument as a string."""
         modname = str(self.__module__)
@@ -195,6 +222,7 @@ class Instrument(SharedGObject):
         Output: None
         '''
 
+        self.flush_changed()
         self._remove_parameters()
         self.emit('removed', self.get_name())
 
@@ -377,15 +405,13 @@ class Instrument(SharedGObject):
 #            property(lambda: self.get(name), lambda x: self.set(name, x)))
 
         if options['flags'] & self.FLAG_PERSIST:
-            val = config.get('persist_%s_%s' % (self._name, name))
-            options['value'] = val
+            options['value'] = persist.get(self._name, name)
         else:
             options['value'] = None
 
         if 'probe_interval' in options:
             interval = int(options['probe_interval'])
-            self._probe_ids.append(gobject.timeout_add(interval,
-                lambda: self.get(name)))
+            get_probe_scheduler().add_probe(self, name, interval)
 
         if 'listen_to' in options:
             insset = set([])
@@ -411,6 +437,7 @@ class Instrument(SharedGObject):
         object can be garbage collected.
         '''
 
+        get_probe_scheduler().remove_instrument(self)
         for name, opts in self._parameters.iteritems():
             for fname in ('get_%s' % name, 'set_%s' % name):
                 if hasattr(self, fname):
@@ -425,6 +452,7 @@ class Instrument(SharedGObject):
             if hasattr(self, func):
                 delattr(self, func)
 
+        get_probe_scheduler().remove_probe(self, name)
         del self._parameters[name]
         self.emit('parameter-removed', name)
 
@@ -434,6 +462,7 @@ class Instrument(SharedGObject):
         '''
         return (name in self._parameters)
 
+    @cache_result(invalidate=_PARAMETER_SIGNALS)
     def get_parameter_options(self, name):
         '''
         Return list of options for paramter.
@@ -446,6 +475,7 @@ class Instrument(SharedGObject):
         else:
             return None
 
+    @cache_result(invalidate=_PARAMETER_SIGNALS)
     def get_shared_parameter_options(self, name):
         '''
         Return list of options for paramter.
@@ -549,6 +579,7 @@ class Instrument(SharedGObject):
         '''
         self.set_parameter_options(name, maxstep=stepsize, stepdelay=stepdelay)
 
+    @cache_result(invalidate=_INTROSPECTION_SIGNALS)
     def get_parameter_names(self):
         '''
         Returns a list of parameter names.
@@ -567,6 +598,7 @@ class Instrument(SharedGObject):
         '''
         return self._parameters
 
+    @cache_result(invalidate=_PARAMETER_SIGNALS)
     def get_shared_parameters(self):
         '''
         Return the parameter dictionary, with non-shareable items stripped.
@@ -711,7 +743,7 @@ class Instrument(SharedGObject):
             base_name = name
 
         func = p['get_func']
-        value = func(**kwargs)
+        value = self._call_driver(name, 'get', func, **kwargs)
         if 'type' in p and value is not None:
             try:
                 if p['type'] == types.IntType:
@@ -732,6 +764,105 @@ class Instrument(SharedGObject):
         p['value'] = value
         return value
 
+    def _call_driver(self, name, direction, func, *args, **kwargs):
+        if Instrument.USE_BUS_ARBITER:
+            self._bus.acquire()
+        try:
+            if Instrument.COLLECT_IO_STATS:
+                return self._timed_call(name, direction, func, *args,
+                        **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            if Instrument.USE_BUS_ARBITER:
+                self._bus.release()
+
+    def _timed_call(self, name, direction, func, *args, **kwargs):
+        start = exact_time()
+        try:
+            ret = func(*args, **kwargs)
+        except:
+            self._io_stats.record((name, direction), exact_time() - start,
+                    error=True)
+            raise
+        self._io_stats.record((name, direction), exact_time() - start)
+        return ret
+
+    def get_io_stats(self):
+        '''
+        Return timing statistics of the driver get and set functions.
+
+        Output: dictionary parameter name -> {'get': stats, 'set': stats},
+            where stats is a dictionary with keys count, errors, total,
+            mean, min, max (in seconds) and histogram (see lib.iostats).
+        '''
+
+        ret = {}
+        for (name, direction), stats in self._io_stats.get().iteritems():
+            if name not in ret:
+                ret[name] = {}
+            ret[name][direction] = stats
+        return ret
+
+    def reset_io_stats(self):
+        '''Clear the timing statistics.'''
+        self._io_stats.reset()
+
+    def get_bus_name(self):
+        '''
+        Return the name of the bus this instrument is on, see set_bus().
+        '''
+        return self._bus.get_name()
+
+    def set_bus(self, name):
+        '''
+        Put the instrument on bus <name>. Instruments on the same physical
+        link should use the same bus, so that their transactions are
+        arbitrated together. Instruments.create() sets the bus from its
+        'bus' argument, or derives it from the address (GPIB board, serial
+        port or Prologix adapter); otherwise each instrument has a bus of
+        its own. Do not call this during a bus transaction.
+        '''
+        self._bus = busarbiter.get_bus_arbiter(name)
+
+    def get_bus_statistics(self):
+        '''Return usage statistics of the bus, see lib.busarbiter.'''
+        return self._bus.get_statistics()
+
+    def bus_transaction(self, prio=None):
+        '''
+        Return a context manager that holds the bus for several operations,
+        for use in drivers and scripts:
+
+            with ins.bus_transaction():
+                ins.set_x(1)
+                ins.get_y()
+        '''
+        return self._bus.transaction(prio)
+
+    def batch(self, max_length=None, check_errors=False):
+        '''
+        Return a context manager that coalesces the SCPI commands written
+        by the driver:
+
+            with ins.batch():
+                ins.set_ch1_amplitude(1)
+                ins.set_ch1_offset(0)
+
+        Writes to the visa instrument (the '_visainstrument' attribute)
+        are joined with ';' into messages of at most <max_length> bytes
+        (default SCPI_INPUT_BUFFER) and sent when a reply is requested or
+        at the end of the block. The bus is held during the block. If the
+        block raises an exception, commands not sent yet are dropped.
+
+        If check_errors is True the error queue (SCPI_ERROR_QUERY) is read
+        at the end; errors are logged and available as the 'errors'
+        attribute of the context manager.
+        '''
+
+        if max_length is None:
+            max_length = self.SCPI_INPUT_BUFFER
+        return _Batch(self, max_length, check_errors)
+
     def get(self, name, query=True, fast=False, **kwargs):
         '''
         Get one or more Instrument parameter values.
@@ -780,6 +911,36 @@ class Instrument(SharedGObject):
 
         return result
 
+    def get_async(self, name, query=True, **kwargs):
+        '''
+        Perform a get in a worker thread and return immediately.
+
+        Instruments with the same lock class share a worker, so gets and
+        sets on a common bus are executed one after another. The bus
+        priority of the calling thread is used for the get.
+
+        Input: see get()
+        Output: calltimer.Future; use result() to obtain the value(s) and
+            calltimer.gather() to wait for several futures.
+        '''
+
+        pool = calltimer.get_worker_pool()
+        return pool.submit(self._lock_class, busarbiter.call_with_priority,
+                busarbiter.get_priority(), self.get, name, query=query,
+                **kwargs)
+
+    def set_async(self, name, value=None, **kwargs):
+        '''
+        Perform a set in a worker thread and return immediately.
+
+        Input: see set()
+        Output: calltimer.Future
+        '''
+
+        pool = calltimer.get_worker_pool()
+        return pool.submit(self._lock_class, busarbiter.call_with_priority,
+                busarbiter.get_priority(), self.set, name, value, **kwargs)
+
     def get_threaded(self, *args, **kwargs):
         '''
         Perform a get in a separate thread. Run gobject main loop while
@@ -789,18 +950,7 @@ class Instrument(SharedGObject):
         if config.get('threading_warning', True):
             logging.warning('Using threading functions could result in QTLab becoming unstable!')
 
-        thread = calltimer.ThreadCall(self.get, *args, **kwargs)
-
-        # In python 2.6 the function is called is_alive
-        try:
-            isalive = thread.is_alive
-        except:
-            isalive = thread.isAlive
-
-        while isalive():
-            qt.flow.run_mainloop(0.005)
-
-        return thread.get_return_value()
+        return self.get_async(*args, **kwargs).result()
 
     def _key_from_format_map_val(self, dic, value):
         for key, val in dic.iteritems():
@@ -963,20 +1113,19 @@ class Instrument(SharedGObject):
                     curval = value
                     delta = 0
 
-                ret = func(curval, **kwargs)
+                ret = self._call_driver(name, 'set', func, curval, **kwargs)
 
                 if delta != 0:
                     time.sleep(delay / 1000.0)
 
         else:
-            ret = func(value, **kwargs)
+            ret = self._call_driver(name, 'set', func, value, **kwargs)
 
         if p['flags'] & self.FLAG_GET_AFTER_SET:
             value = self._get_value(name, **kwargs)
 
         if p['flags'] & self.FLAG_PERSIST:
-            config.set('persist_%s_%s' % (self._name, name), value)
-            config.save()
+            persist.set(self._name, name, value)
 
         p['value'] = value
         return value
@@ -1073,6 +1222,7 @@ class Instrument(SharedGObject):
 
         self._functions[name] = options
 
+    @cache_result(invalidate=_INTROSPECTION_SIGNALS)
     def get_function_options(self, name):
         '''
         Return options for an Instrument function.
@@ -1085,6 +1235,7 @@ class Instrument(SharedGObject):
         else:
             return None
 
+    @cache_result(invalidate=_INTROSPECTION_SIGNALS)
     def get_function_parameters(self, name):
         '''
         Return info about parameters for function.
@@ -1094,6 +1245,7 @@ class Instrument(SharedGObject):
                 return self._functions[name]['parameters']
         return None
 
+    @cache_result(invalidate=_INTROSPECTION_SIGNALS)
     def get_function_names(self):
         '''
         Return the list of exposed Instrument function names.
@@ -1190,17 +1342,126 @@ class Instrument(SharedGObject):
 
         update_func()
 
+    def set_changed_interval(self, interval):
+        '''
+        Set the minimum time (in seconds) between two 'changed' signals.
+
+        Changes queued within this interval are merged; only the latest
+        value of each parameter is emitted. The last change is always
+        emitted, at most <interval> seconds late. Use 0 to emit on every
+        main loop iteration.
+
+        The default is config['changed_interval'], or the 'changed_interval'
+        argument of Instruments.create().
+        '''
+        self._changed_interval = interval
+
+    def get_changed_interval(self):
+        return self._changed_interval
+
+    def get_changed_statistics(self):
+        '''
+        Return a dictionary with the number of changes queued, the number
+        of 'changed' signals emitted and the number of parameter values that
+        were replaced by a newer value before being emitted.
+        '''
+        return dict(self._changed_stats)
+
+    def reset_changed_statistics(self):
+        self._changed_stats = {
+            'queued': 0,
+            'emitted': 0,
+            'coalesced': 0,
+        }
+
+    def flush_changed(self):
+        '''
+        Emit pending changes now.
+        '''
+        if self._changed_hid is not None:
+            gobject.source_remove(self._changed_hid)
+            self._do_emit_changed()
+
     def _do_emit_changed(self):
-        # was this a bug?
-        self.emit('changed', self._changed)
+        changed = self._changed
         self._changed = {}
         self._changed_hid = None
+        self._changed_last_emit = exact_time()
+        self._changed_stats['emitted'] += 1
+        self.emit('changed', changed)
+        return False
 
     def _queue_changed(self, changed):
+        stats = self._changed_stats
+        stats['queued'] += 1
+        for key in changed:
+            if key in self._changed:
+                stats['coalesced'] += 1
         self._changed.update(changed)
-        if self._changed_hid is None:
+
+        if self._changed_hid is not None:
+            return
+
+        if self._changed_last_emit is None:
+            delay = 0
+        else:
+            delay = self._changed_last_emit + self._changed_interval - \
+                    exact_time()
+        if delay > 0:
+            self._changed_hid = gobject.timeout_add(int(delay * 1000) + 1,
+                    self._do_emit_changed)
+        else:
             self._changed_hid = gobject.idle_add(self._do_emit_changed)
 
+class _Batch():
+
+    def __init__(self, ins, max_length, check_errors):
+        self._ins = ins
+        self._max_length = max_length
+        self._check_errors = check_errors
+        self._writer = None
+        self.errors = []
+
+    def __enter__(self):
+        self._ins._bus.acquire()
+        visains = getattr(self._ins, '_visainstrument', None)
+        if visains is None:
+            logging.warning('Instrument %s has no visa instrument, '
+                    'not combining commands', self._ins.get_name())
+        elif not isinstance(visains, visa.CoalescingWriter):
+            self._writer = visa.CoalescingWriter(visains, self._max_length)
+            self._ins._visainstrument = self._writer
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if self._writer is None:
+                return
+            self._ins._visainstrument = self._writer.get_instrument()
+            if exc_type is not None:
+                dropped = self._writer.discard()
+                if len(dropped) > 0:
+                    logging.warning('Instrument %s: not sending %d commands '
+                        'after error', self._ins.get_name(), len(dropped))
+                return
+            self._writer.flush()
+            if self._check_errors:
+                self.errors = self._read_errors()
+        finally:
+            self._ins._bus.release()
+
+    def _read_errors(self):
+        visains = self._ins._visainstrument
+        errors = []
+        for i in range(32):
+            reply = visains.ask(self._ins.SCPI_ERROR_QUERY).strip()
+            if reply == '' or reply.lstrip('+').startswith('0'):
+                break
+            errors.append(reply)
+            logging.warning('Instrument %s reported error: %s',
+                    self._ins.get_name(), reply)
+        return errors
+
 class InvalidInstrument(Instrument):
     '''
     Placeholder class for instruments that fail to load, mainly to support
@@ -22,10 +22,14 @@ import types
 import os
 import logging
 import sys
+import re
 import instrument
+from lib import calltimer
+from lib import busarbiter
 from lib.config import get_config
+from lib.misc import exact_time, get_dict_keys
 from insproxy import Proxy
-from lib.network.object_sharer import SharedGObject
+from lib.network.object_sharer import SharedGObject, cache_result
 
 from lib.misc import get_traceback
 TB = get_traceback()()
@@ -87,6 +91,35 @@ def _get_driver_module(name, do_reload=False):
 
     return None
 
+_BOARD_RE = re.compile('^(GPIB|ASRL|COM)(\d*)(::|$)', re.I)
+
+def _get_bus_name(address, visa_driver):
+    '''
+    Return the name of the physical link used to reach <address>: the
+    Prologix adapter, the GPIB board or the serial port. Returns None for
+    transports with a link per device (TCP/IP, USB) or unknown ones.
+    '''
+
+    if visa_driver == 'prologix_ethernet':
+        import prologix_ethernet
+        return 'prologix_%s:%s' % (prologix_ethernet.ip,
+                prologix_ethernet.port)
+
+    if type(address) not in types.StringTypes:
+        return None
+    m = _BOARD_RE.match(address)
+    if m is None:
+        return None
+    kind = m.group(1).upper()
+    if kind == 'COM':
+        kind = 'ASRL'
+    board = m.group(2)
+    if board == '':
+        if kind == 'ASRL':
+            return None
+        board = '0'
+    return '%s%s' % (kind, board)
+
 class Instruments(SharedGObject):
 
     __gsignals__ = {
@@ -104,6 +137,10 @@ class Instruments(SharedGObject):
                     ([gobject.TYPE_PYOBJECT]))
     }
 
+    # create() arguments that select the transport or configure the
+    # framework; drivers do not get them
+    CREATE_ONLY_ARGS = ('visa', 'bus', 'changed_interval')
+
     __id = 1
     def __init__(self):
         SharedGObject.__init__(self, 'instruments%d' % Instruments.__id)
@@ -170,6 +207,7 @@ class Instruments(SharedGObject):
         else:
             return None
 
+    @cache_result(invalidate=('instrument-added', 'instrument-removed'))
     def get_instrument_names(self):
         keys = self._instruments.keys()
         keys.sort()
@@ -245,6 +283,169 @@ class Instruments(SharedGObject):
                 ret.append(ins)
         return ret
 
+    def _get_all_func(self, ins):
+        '''
+        Return function that reads all parameters of instrument <ins>: the
+        driver's get_all() if available, otherwise a get of all gettable
+        parameters.
+        '''
+
+        if hasattr(ins, 'get_all'):
+            return ins.get_all
+
+        names = []
+        for name, opts in ins.get_parameters().iteritems():
+            if opts['flags'] & instrument.Instrument.FLAG_GET:
+                names.append(name)
+        return lambda: ins.get(names)
+
+    def get_all_parallel(self, names=None, timeout=10.0, nslow=5,
+            total_timeout=None):
+        '''
+        Read all parameters of several instruments concurrently.
+
+        Instruments are grouped by lock class; instruments sharing a lock
+        class (e.g. the same GPIB bus) are read one after another, different
+        groups are read in parallel.
+
+        Input:
+            names (list of strings): instruments to read, default all
+            timeout (float): maximum time in seconds for a single instrument
+            nslow (int): number of slowest instruments to report in the log
+            total_timeout (float): maximum time in seconds for the whole
+                call, including the time instruments spend queued behind
+                others of the same lock class. Default is <timeout> times
+                the size of the largest lock class group.
+
+        Output:
+            dictionary of instrument name -> info dictionary with keys
+            'status' ('ok', 'error', 'timeout' or 'skipped'), 'duration'
+            (seconds, None if not finished) and 'error' (string or None).
+        '''
+
+        if names is None:
+            names = self.get_instrument_names()
+
+        pool = calltimer.get_worker_pool()
+        prio = busarbiter.get_priority()
+        info = {}
+        pending = {}
+        groups = {}
+        start = exact_time()
+        for name in names:
+            ins = self._instruments.get(name, None)
+            if ins is None:
+                logging.warning('Instrument %s not found', name)
+                continue
+
+            info[name] = {'status': None, 'duration': None, 'error': None,
+                    'start': None, 'lockclass': ins._lock_class}
+            pending[name] = pool.submit(ins._lock_class,
+                    busarbiter.call_with_priority, prio, self._timed_call,
+                    info[name], self._get_all_func(ins))
+            groups[ins._lock_class] = groups.get(ins._lock_class, 0) + 1
+
+        if total_timeout is None:
+            total_timeout = timeout * max([1] + groups.values())
+        deadline = start + total_timeout
+
+        while len(pending) > 0:
+            now = exact_time()
+            timed_out = set()
+            for name, future in pending.items():
+                i = info[name]
+                if future.done():
+                    if future.exception(0, mainloop=False) is not None:
+                        i['status'] = 'error'
+                        i['error'] = str(future.exception(0, mainloop=False))
+                    else:
+                        i['status'] = 'ok'
+                    del pending[name]
+                elif i['start'] is not None and (now - i['start'] > timeout \
+                        or now > deadline):
+                    i['status'] = 'timeout'
+                    timed_out.add(i['lockclass'])
+                    del pending[name]
+
+            # Instruments queued behind a hanging one will not be reached,
+            # drop them from the worker queue as well.
+            for name, future in pending.items():
+                i = info[name]
+                if i['lockclass'] in timed_out or now > deadline:
+                    if future.cancel():
+                        i['status'] = 'skipped'
+                        del pending[name]
+
+            if len(pending) > 0:
+                pending.values()[0].wait(0.01)
+
+        ret = {}
+        for name, i in info.iteritems():
+            ret[name] = get_dict_keys(i, ('status', 'duration', 'error'))
+
+        self._log_get_all_summary(ret, nslow)
+        return ret
+
+    def _timed_call(self, info, func):
+        info['start'] = exact_time()
+        try:
+            return func()
+        finally:
+            info['duration'] = exact_time() - info['start']
+
+    def _log_get_all_summary(self, info, nslow):
+        for name, i in info.iteritems():
+            if i['status'] == 'error':
+                logging.warning('get_all of %s failed: %s', name, i['error'])
+            elif i['status'] in ('timeout', 'skipped'):
+                logging.warning('get_all of %s: %s', name, i['status'])
+
+        durations = [(i['duration'], name) for name, i in info.iteritems() \
+                if i['duration'] is not None]
+        durations.sort(reverse=True)
+        if len(durations) > 0:
+            slow = ', '.join(['%s (%.03fs)' % (name, dur) \
+                    for dur, name in durations[:nslow]])
+            logging.info('Slowest instruments in get_all: %s', slow)
+
+    def get_slowest_parameters(self, n=10, key='mean'):
+        '''
+        Return the <n> slowest instrument parameter accesses.
+
+        Input:
+            n (int): number of entries to return
+            key (string): statistic to sort on, e.g. 'mean', 'max' or 'total'
+
+        Output:
+            list of (instrument, parameter, direction, stats) tuples, see
+            Instrument.get_io_stats() for the contents of stats.
+        '''
+
+        ret = []
+        for insname, ins in self._instruments.iteritems():
+            for param, dirstats in ins.get_io_stats().iteritems():
+                for direction, stats in dirstats.iteritems():
+                    ret.append((insname, param, direction, stats))
+
+        ret.sort(key=lambda x: x[3][key], reverse=True)
+        return ret[:n]
+
+    def reset_io_stats(self):
+        '''Clear the timing statistics of all instruments.'''
+        for ins in self._instruments.values():
+            ins.reset_io_stats()
+
+    def get_bus_statistics(self):
+        '''
+        Return usage statistics of all instrument buses, as a dictionary
+        bus name -> statistics (see lib.busarbiter).
+        '''
+        return busarbiter.get_bus_statistics()
+
+    def reset_bus_statistics(self):
+        busarbiter.reset_bus_statistics()
+
+    @cache_result(invalidate=('tags-added', ))
     def get_tags(self):
         '''
         Return list of tags present in instruments.
@@ -267,6 +468,14 @@ class Instruments(SharedGObject):
                 (3) optional: keyword arguments.
                     (1) tags, array of strings representing tags
                     (2) many instruments require address=<address>
+                    (3) visa, VISA provider to use (default 'pyvisa')
+                    (4) bus, name of the physical link the instrument is
+                        on, see Instrument.set_bus(). By default this is
+                        derived from the address and VISA provider.
+                    (5) changed_interval, minimum time between 'changed'
+                        signals, see Instrument.set_changed_interval()
+                    Arguments in CREATE_ONLY_ARGS are used here and not
+                    passed to the driver.
 
         Output: Instrument object (Proxy)
         '''
@@ -293,13 +502,26 @@ class Instruments(SharedGObject):
             logging.error('Driver does not contain instrument class')
             return self._create_invalid_ins(name, instype, **kwargs)
 
+        driver_kwargs = dict(kwargs)
+        for key in self.CREATE_ONLY_ARGS:
+            driver_kwargs.pop(key, None)
+
         try:
-            ins = insclass(name, **kwargs)
+            ins = insclass(name, **driver_kwargs)
         except Exception, e:
             TB()
             logging.error('Error creating instrument %s', name)
             return self._create_invalid_ins(name, instype, **kwargs)
 
+        # Unless the driver chose a bus, use the one derived from the address
+        bus = kwargs.get('bus', None)
+        if bus is None and ins.get_bus_name() == ins._lock_class:
+            bus = _get_bus_name(kwargs.get('address', None), visa_driver)
+        if bus is not None:
+            ins.set_bus(bus)
+        if 'changed_interval' in kwargs:
+            ins.set_changed_interval(kwargs['changed_interval'])
+
         self.add(ins, create_args=kwargs)
         self.emit('instrument-added', name)
         return self.get(name)
@@ -0,0 +1,229 @@
+# benchmark.py, helpers to measure and compare framework overhead
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Small benchmark harness.
+
+A BenchmarkSuite runs named functions repeatedly, stores the time per call
+and writes the results to a JSON file. Two result files can be compared to
+find regressions; from the command line:
+
+    python benchmark.py [--threshold 0.1] old.json new.json
+'''
+
+import os
+import sys
+import time
+import logging
+import subprocess
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+def timeit(func, n=None, mintime=0.2, repeat=3):
+    '''
+    Return the best time per call (in seconds) of func().
+
+    If n is None the number of calls is increased until a run takes at
+    least <mintime> seconds. The best of <repeat> runs is returned.
+    '''
+
+    # Not imported at module level: when comparing results from the command
+    # line lib/ is first in sys.path and lib/math hides the standard module.
+    from misc import exact_time
+
+    if n is None:
+        n = 1
+        while True:
+            start = exact_time()
+            for i in xrange(n):
+                func()
+            if exact_time() - start >= mintime or n >= 1e7:
+                break
+            n *= 10
+
+    best = None
+    for r in xrange(repeat):
+        start = exact_time()
+        for i in xrange(n):
+            func()
+        dt = (exact_time() - start) / n
+        if best is None or dt < best:
+            best = dt
+
+    return best, n
+
+def get_git_revision(path=None):
+    '''Return the current git commit id of <path>, or None.'''
+    if path is None:
+        path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=path,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode == 0:
+            return out.strip()
+    except Exception, e:
+        pass
+    return None
+
+class BenchmarkSuite():
+    '''
+    Collection of benchmark results.
+    '''
+
+    def __init__(self, name='qtlab', mintime=0.2, repeat=3):
+        self._name = name
+        self._mintime = mintime
+        self._repeat = repeat
+        self._results = {}
+
+    def run(self, name, func, n=None, setup=None, teardown=None):
+        '''
+        Time func() and store the result as <name>.
+
+        setup() and teardown() are called before and after timing, if given.
+        Exceptions are logged and the benchmark is marked as failed.
+        '''
+
+        try:
+            if setup is not None:
+                setup()
+            dt, n = timeit(func, n=n, mintime=self._mintime,
+                    repeat=self._repeat)
+            if teardown is not None:
+                teardown()
+        except Exception, e:
+            logging.warning('Benchmark %s failed: %s', name, str(e))
+            self._results[name] = {'error': str(e)}
+            return None
+
+        self.add_result(name, dt, n)
+        return dt
+
+    def add_result(self, name, dt, n=1, **extra):
+        '''
+        Store a result measured elsewhere; dt is the time per call.
+        '''
+
+        res = {
+            'time': dt,
+            'calls': n,
+            'rate': 1.0 / dt if dt > 0 else None,
+        }
+        res.update(extra)
+        self._results[name] = res
+        print '%-40s %12.3f us/call' % (name, dt * 1e6)
+
+    def skip(self, name, reason):
+        print '%-40s skipped: %s' % (name, reason)
+        self._results[name] = {'skipped': reason}
+
+    def get_results(self):
+        return self._results
+
+    def save(self, filename, **metadata):
+        '''
+        Write results to JSON file <filename>, together with the git
+        revision, time and optional extra metadata.
+        '''
+
+        info = {
+            'name': self._name,
+            'revision': get_git_revision(),
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+        }
+        info.update(metadata)
+
+        f = open(filename, 'w')
+        json.dump({'info': info, 'results': self._results}, f,
+                indent=4, sort_keys=True)
+        f.close()
+
+def load(filename):
+    f = open(filename, 'r')
+    ret = json.load(f)
+    f.close()
+    return ret
+
+def compare(old, new, threshold=0.1):
+    '''
+    Compare two result dictionaries (as returned by load()).
+
+    Output: list of (name, old time, new time, ratio, status) tuples, where
+        status is 'regression', 'improvement' or 'ok' depending on whether
+        the time per call changed by more than <threshold> (fraction).
+    '''
+
+    ret = []
+    oldres = old['results']
+    newres = new['results']
+    names = list(set(oldres.keys()) & set(newres.keys()))
+    names.sort()
+    for name in names:
+        t0 = oldres[name].get('time', None)
+        t1 = newres[name].get('time', None)
+        if not t0 or not t1:
+            continue
+
+        ratio = t1 / t0
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        ret.append((name, t0, t1, ratio, status))
+
+    return ret
+
+def print_comparison(old, new, threshold=0.1):
+    '''
+    Print comparison of two result dictionaries, return number of
+    regressions.
+    '''
+
+    print 'Old: %s (%s)' % (old['info'].get('revision'), old['info'].get('timestamp'))
+    print 'New: %s (%s)' % (new['info'].get('revision'), new['info'].get('timestamp'))
+
+    nreg = 0
+    for name, t0, t1, ratio, status in compare(old, new, threshold):
+        if status == 'regression':
+            nreg += 1
+        if status == 'ok':
+            status = ''
+        print '%-40s %12.3f %12.3f us %6.2fx %s' % \
+                (name, t0 * 1e6, t1 * 1e6, ratio, status)
+
+    return nreg
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] old.json new.json',
+        description='Compare QTLab benchmark results')
+    parser.add_option('-t', '--threshold', type=float, default=0.1,
+        help='Relative change to flag as regression (default 0.1)')
+    args, pargs = parser.parse_args()
+    if len(pargs) != 2:
+        parser.error('Need two result files')
+
+    nreg = print_comparison(load(pargs[0]), load(pargs[1]), args.threshold)
+    if nreg > 0:
+        sys.exit(1)
@@ -0,0 +1,339 @@
+# busarbiter.py, priority based access to shared instrument buses
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Arbitration of transactions on shared physical links (a GPIB bus, a
+Prologix adapter, a serial port).
+
+Each link has a BusArbiter. A transaction holds the bus until it is done;
+when the bus becomes free the waiting transaction with the highest
+priority gets it, oldest first within a priority:
+
+    PRIORITY_MEASUREMENT: the measurement loop
+    PRIORITY_INTERACTIVE: GUI and remote clients
+    PRIORITY_BACKGROUND: probes and other monitoring
+
+To avoid starvation a waiting background transaction is promoted one
+level for every <aging> seconds it waits, but never above
+PRIORITY_INTERACTIVE, so it can not overtake the measurement loop.
+
+The priority of a transaction is taken from the innermost 'with
+priority(p):' block of the calling thread. Without one, the main thread
+uses PRIORITY_MEASUREMENT while a measurement is running and
+PRIORITY_INTERACTIVE otherwise; other threads use PRIORITY_BACKGROUND.
+'''
+
+import thread
+import threading
+import time
+import logging
+
+from qtflow import get_flowcontrol
+from lib.misc import exact_time
+
+PRIORITY_MEASUREMENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_MEASUREMENT: 'measurement',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+_local = threading.local()
+
+class priority():
+    '''
+    Context manager to set the bus priority of the current thread:
+
+        with busarbiter.priority(busarbiter.PRIORITY_BACKGROUND):
+            ins.get('temperature')
+    '''
+
+    def __init__(self, prio):
+        self._prio = prio
+
+    def __enter__(self):
+        if not hasattr(_local, 'priorities'):
+            _local.priorities = []
+        _local.priorities.append(self._prio)
+        return self
+
+    def __exit__(self, *args):
+        _local.priorities.pop()
+
+def get_priority():
+    '''Return the bus priority of the current thread.'''
+    prios = getattr(_local, 'priorities', None)
+    if prios:
+        return prios[-1]
+    if threading.currentThread().getName() == 'MainThread':
+        if get_flowcontrol().is_measuring():
+            return PRIORITY_MEASUREMENT
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BACKGROUND
+
+def call_with_priority(prio, func, *args, **kwargs):
+    '''Call func(*args, **kwargs) with bus priority <prio>.'''
+    with priority(prio):
+        return func(*args, **kwargs)
+
+class _Waiter():
+
+    def __init__(self, prio, seq):
+        self.prio = prio
+        self.seq = seq
+        self.start = exact_time()
+        self.owner = thread.get_ident()
+        self.lock = thread.allocate_lock()
+        self.lock.acquire()
+
+    def get_rank(self, now, aging):
+        prio = self.prio
+        if prio > PRIORITY_INTERACTIVE and aging > 0:
+            prio = max(PRIORITY_INTERACTIVE,
+                    prio - int((now - self.start) / aging))
+        return (prio, self.seq)
+
+class BusArbiter():
+    '''
+    Priority lock for one physical link. The thread that owns the bus can
+    acquire it again (e.g. a driver get that calls another get).
+    '''
+
+    def __init__(self, name, aging=1.0):
+        self._name = name
+        self._aging = aging
+        self._lock = thread.allocate_lock()
+        self._owner = None
+        self._depth = 0
+        self._seq = 0
+        self._waiters = []
+
+        self._granted_at = 0
+        self._granted_prio = None
+        self._stats = {}
+        self.reset_statistics()
+
+    def get_name(self):
+        return self._name
+
+    def set_aging(self, aging):
+        self._aging = aging
+
+    def acquire(self, prio=None, timeout=None):
+        '''
+        Wait until the bus is available and take it.
+
+        Input:
+            prio (int): priority, default from get_priority()
+            timeout (float): maximum time to wait, None to wait forever
+        Output:
+            True if the bus was acquired, False on timeout
+        '''
+
+        me = thread.get_ident()
+        if self._owner == me:
+            self._depth += 1
+            return True
+
+        if prio is None:
+            prio = get_priority()
+
+        self._lock.acquire()
+        self._seq += 1
+        if self._owner is None and len(self._waiters) == 0:
+            self._grant(me, prio, 0)
+            self._lock.release()
+            return True
+
+        w = _Waiter(prio, self._seq)
+        self._waiters.append(w)
+        self._stats['contended'] += 1
+        self._lock.release()
+
+        if timeout is None:
+            w.lock.acquire()
+            return True
+
+        # Thread locks can not wait with a timeout, so poll
+        deadline = exact_time() + timeout
+        while not w.lock.acquire(False):
+            if exact_time() > deadline:
+                self._lock.acquire()
+                if w in self._waiters:
+                    self._waiters.remove(w)
+                    self._stats['timeouts'] += 1
+                    self._lock.release()
+                    return False
+                self._lock.release()
+                w.lock.acquire()
+                return True
+            time.sleep(0.0005)
+        return True
+
+    def release(self):
+        if self._owner != thread.get_ident():
+            raise RuntimeError('Bus %s released by thread not owning it' % \
+                    self._name)
+
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        self._lock.acquire()
+        try:
+            now = exact_time()
+            pstats = self._stats['priorities'][self._granted_prio]
+            pstats['busy'] += now - self._granted_at
+            self._owner = None
+
+            if len(self._waiters) == 0:
+                return
+
+            best = min(self._waiters,
+                    key=lambda w: w.get_rank(now, self._aging))
+            self._waiters.remove(best)
+            if best.get_rank(now, self._aging)[0] < best.prio:
+                self._stats['promoted'] += 1
+            self._grant(best.owner, best.prio, now - best.start)
+            best.lock.release()
+        finally:
+            self._lock.release()
+
+    def _grant(self, owner, prio, waited):
+        # Called with self._lock held
+        self._owner = owner
+        self._depth = 1
+        self._granted_at = exact_time()
+        self._granted_prio = prio
+
+        pstats = self._stats['priorities'][prio]
+        pstats['count'] += 1
+        pstats['wait'] += waited
+        pstats['max_wait'] = max(pstats['max_wait'], waited)
+
+    def transaction(self, prio=None):
+        '''
+        Context manager to hold the bus for a group of operations:
+
+            with arbiter.transaction():
+                ...
+        '''
+        return _Transaction(self, prio)
+
+    def get_queue_length(self):
+        return len(self._waiters)
+
+    def reset_statistics(self):
+        self._lock.acquire()
+        self._stats = {
+            'start': exact_time(),
+            'contended': 0,
+            'promoted': 0,
+            'timeouts': 0,
+            'priorities': {},
+        }
+        for prio in PRIORITY_NAMES:
+            self._stats['priorities'][prio] = {
+                'count': 0,
+                'busy': 0.0,
+                'wait': 0.0,
+                'max_wait': 0.0,
+            }
+        self._lock.release()
+
+    def get_statistics(self):
+        '''
+        Return usage statistics since the last reset:
+            utilization: fraction of time the bus was in use
+            contended: number of transactions that had to wait
+            promoted: number of transactions promoted by aging
+            timeouts: number of acquires that timed out
+            queued: number of transactions waiting now
+            <priority name>: dict with count, busy (s), utilization,
+                mean_wait (s) and max_wait (s) for that priority
+        '''
+
+        self._lock.acquire()
+        try:
+            elapsed = max(exact_time() - self._stats['start'], 1e-9)
+            ret = {
+                'contended': self._stats['contended'],
+                'promoted': self._stats['promoted'],
+                'timeouts': self._stats['timeouts'],
+                'queued': len(self._waiters),
+            }
+
+            busy = 0
+            for prio, pstats in self._stats['priorities'].iteritems():
+                busy += pstats['busy']
+                if pstats['count'] > 0:
+                    mean_wait = pstats['wait'] / pstats['count']
+                else:
+                    mean_wait = 0
+                ret[PRIORITY_NAMES[prio]] = {
+                    'count': pstats['count'],
+                    'busy': pstats['busy'],
+                    'utilization': pstats['busy'] / elapsed,
+                    'mean_wait': mean_wait,
+                    'max_wait': pstats['max_wait'],
+                }
+            ret['utilization'] = busy / elapsed
+            return ret
+        finally:
+            self._lock.release()
+
+class _Transaction():
+
+    def __init__(self, arbiter, prio):
+        self._arbiter = arbiter
+        self._prio = prio
+
+    def __enter__(self):
+        self._arbiter.acquire(self._prio)
+        return self._arbiter
+
+    def __exit__(self, *args):
+        self._arbiter.release()
+
+_arbiters = {}
+_arbiters_lock = threading.Lock()
+
+def get_bus_arbiter(name):
+    '''Return the arbiter for bus <name>, create it if needed.'''
+    _arbiters_lock.acquire()
+    try:
+        if name not in _arbiters:
+            _arbiters[name] = BusArbiter(name)
+        return _arbiters[name]
+    finally:
+        _arbiters_lock.release()
+
+def get_bus_names():
+    return _arbiters.keys()
+
+def get_bus_statistics():
+    '''Return dictionary of bus name -> statistics.'''
+    ret = {}
+    for name, arbiter in _arbiters.items():
+        ret[name] = arbiter.get_statistics()
+    return ret
+
+def reset_bus_statistics():
+    for arbiter in _arbiters.values():
+        arbiter.reset_statistics()
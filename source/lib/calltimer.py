@@ -23,6 +23,7 @@ import gtk
 #gtk.gdk.threads_init()
 
 import threading
+import Queue
 import time
 from misc import exact_time
 
@@ -233,3 +234,231 @@ class ThreadCall(threading.Thread):
 
     def get_return_value(self):
         return self._return_value
+
+class CancelledError(Exception):
+    pass
+
+class Future():
+    '''
+    Result of a function executed by a WorkerPool.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._running = False
+        self._cancelled = False
+
+    def done(self):
+        '''Return whether the call has finished or was cancelled.'''
+        return self._event.isSet()
+
+    def running(self):
+        '''Return whether the call is being executed right now.'''
+        return self._running and not self.done()
+
+    def cancelled(self):
+        '''Return whether the call was cancelled.'''
+        return self._cancelled
+
+    def cancel(self):
+        '''
+        Cancel the call if it has not been started yet; a cancelled call
+        is dropped from the worker queue without being executed.
+
+        Output: True if the call was cancelled, False if it is already
+        running or finished.
+        '''
+
+        self._lock.acquire()
+        if self._running or self._event.isSet():
+            self._lock.release()
+            return self._cancelled
+        self._cancelled = True
+        self._lock.release()
+
+        self._set_done(None, CancelledError('Call cancelled'))
+        return True
+
+    def _set_running(self):
+        '''Mark the call as started, returns False if it was cancelled.'''
+        self._lock.acquire()
+        if self._cancelled:
+            self._lock.release()
+            return False
+        self._running = True
+        self._lock.release()
+        return True
+
+    def wait(self, timeout=None, mainloop=True):
+        '''
+        Wait for the call to finish, for at most <timeout> seconds.
+
+        If mainloop is True the gobject main loop is run while waiting, so
+        that the GUI and shared objects stay responsive.
+
+        Returns whether the call has finished.
+        '''
+
+        if not mainloop:
+            self._event.wait(timeout)
+            return self.done()
+
+        import qt
+        start = exact_time()
+        while not self._event.isSet():
+            qt.flow.run_mainloop(0.001, wait=False)
+            if timeout is None:
+                delay = 0.005
+            else:
+                delay = min(0.005, timeout - (exact_time() - start))
+                if delay <= 0:
+                    break
+            self._event.wait(delay)
+
+        return self.done()
+
+    def result(self, timeout=None, mainloop=True):
+        '''
+        Return the result of the call, waiting for at most <timeout> seconds.
+        Exceptions raised by the call are raised again here.
+        '''
+
+        if not self.wait(timeout, mainloop=mainloop):
+            raise RuntimeError('Timeout waiting for result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None, mainloop=True):
+        '''Return the exception raised by the call, or None.'''
+        if not self.wait(timeout, mainloop=mainloop):
+            raise RuntimeError('Timeout waiting for result')
+        return self._exception
+
+    def add_done_callback(self, func):
+        '''
+        Call func(future) when the call has finished. Note that the callback
+        is executed in the worker thread; use gobject.idle_add to get back
+        to the main loop.
+        '''
+
+        self._lock.acquire()
+        if not self._event.isSet():
+            self._callbacks.append(func)
+            func = None
+        self._lock.release()
+
+        if func is not None:
+            func(self)
+
+    def _set_done(self, result, exception):
+        self._lock.acquire()
+        self._result = result
+        self._exception = exception
+        self._event.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        self._lock.release()
+
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, e:
+                logging.warning('Future callback %s failed: %s', func, e)
+
+class _Worker(threading.Thread):
+
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self._queue = Queue.Queue()
+
+    def submit(self, future, func, args, kwargs):
+        self._queue.put((future, func, args, kwargs))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, func, args, kwargs = item
+            if not future._set_running():
+                continue
+            try:
+                ret = func(*args, **kwargs)
+                future._set_done(ret, None)
+            except Exception, e:
+                future._set_done(None, e)
+
+class WorkerPool():
+    '''
+    Pool of worker threads, one per key. Calls submitted with the same key
+    are executed one after another, calls with different keys run
+    concurrently. Instruments use their lock class as key, so that devices
+    sharing a bus are never accessed at the same time.
+    '''
+
+    def __init__(self):
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        '''
+        Execute func(*args, **kwargs) in the worker for <key>.
+
+        Output: Future
+        '''
+
+        self._lock.acquire()
+        if key not in self._workers:
+            worker = _Worker('worker_%s' % (key, ))
+            worker.start()
+            self._workers[key] = worker
+        worker = self._workers[key]
+        self._lock.release()
+
+        future = Future()
+        worker.submit(future, func, args, kwargs)
+        return future
+
+    def shutdown(self):
+        '''Stop all workers after they have finished their queued calls.'''
+        self._lock.acquire()
+        for worker in self._workers.values():
+            worker.stop()
+        self._workers = {}
+        self._lock.release()
+
+def gather(futures, timeout=None, mainloop=True):
+    '''
+    Wait for all futures to finish and return a list of their results.
+    The first exception raised by any of the calls is raised again.
+    '''
+
+    start = exact_time()
+    for f in futures:
+        if timeout is None:
+            remaining = None
+        else:
+            remaining = max(0, timeout - (exact_time() - start))
+        if not f.wait(remaining, mainloop=mainloop):
+            raise RuntimeError('Timeout waiting for results')
+
+    return [f.result(0, mainloop=False) for f in futures]
+
+_worker_pool = None
+
+def get_worker_pool():
+    '''Get the global worker pool.'''
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool()
+    return _worker_pool
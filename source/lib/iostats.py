@@ -0,0 +1,71 @@
+# iostats.py, timing statistics for instrument I/O
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import bisect
+
+# Upper edges (in seconds) of the latency histogram bins; the last bin
+# holds everything slower than the last edge.
+HISTOGRAM_EDGES = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0)
+
+class IOStats():
+    '''
+    Collect call counts, error counts and a latency histogram per
+    (parameter, direction) key. Recording a call is a handful of dictionary
+    and list operations, so it can be left enabled.
+    '''
+
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, key, duration, error=False):
+        s = self._stats.get(key, None)
+        if s is None:
+            s = [0, 0, 0.0, duration, duration,
+                    [0] * (len(HISTOGRAM_EDGES) + 1)]
+            self._stats[key] = s
+
+        s[0] += 1
+        if error:
+            s[1] += 1
+        s[2] += duration
+        if duration < s[3]:
+            s[3] = duration
+        if duration > s[4]:
+            s[4] = duration
+        s[5][bisect.bisect_left(HISTOGRAM_EDGES, duration)] += 1
+
+    def reset(self):
+        self._stats = {}
+
+    def get(self):
+        '''
+        Return dictionary key -> statistics dict with keys count, errors,
+        total, mean, min, max (seconds) and histogram (counts per bin, see
+        HISTOGRAM_EDGES).
+        '''
+
+        ret = {}
+        for key, s in self._stats.iteritems():
+            ret[key] = {
+                'count': s[0],
+                'errors': s[1],
+                'total': s[2],
+                'mean': s[2] / s[0],
+                'min': s[3],
+                'max': s[4],
+                'histogram': list(s[5]),
+            }
+        return ret
@@ -20,20 +20,339 @@ try:
     import cPickle as pickle
 except:
     import pickle
+import os
 import socket
+import select
+import mmap
+import tempfile
+import zlib
+import errno
+import struct
 import copy
 import random
 import inspect
 import time
 import gobject
 import types
+import numpy
+from collections import OrderedDict
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
 
 PORT = 12002
 BUFSIZE = 8192
 
+# Receive sizes are adapted between these limits
+RECV_MIN = 64 * 1024
+RECV_MAX = 4 * 1024 * 1024
+
+# Packets of at least this size are not copied out of the receive buffer;
+# the buffer is handed over to the packet instead.
+LARGE_PACKET = 1024 * 1024
+
+# Numpy arrays of at least this size are sent out of band, i.e. as raw
+# data after the pickle instead of inside it (if the peer supports it).
+OOB_MIN_SIZE = 4096
+
+# Features of this implementation; peers exchange them in add_client()
+CAPABILITIES = ('oob_arrays', 'batch_calls', 'signal_subscriptions', 'shm',
+        'zlib')
+
+# Maximum amount of data (bytes) queued for a connection. Signals for a
+# client that is this far behind are dropped; replies and STRUCTURAL_SIGNALS
+# are always queued.
+SEND_QUEUE_LIMIT = 32 * 1024 * 1024
+
+# Signals that change the structure of an object and invalidate results
+# cached by clients (see cache_result). They are rare, so they are never
+# dropped: a client that misses one would keep a stale cache.
+STRUCTURAL_SIGNALS = ('parameter-added', 'parameter-removed',
+        'parameter-changed', 'instrument-added', 'instrument-removed',
+        'instrument-changed', 'object-added', 'object-removed', 'removed',
+        'reload', 'tags-added')
+
+# Signals that only describe the latest state. When a client falls behind
+# only the last one is kept; for signals with a dict as last argument
+# (e.g. instrument 'changed') the dicts are merged.
+COALESCE_SIGNALS = ('changed', 'new-data-point')
+
+# Peers on the same host pass packets with out-of-band arrays of at least
+# SHM_MIN_SIZE bytes through a shared memory ring buffer of SHM_SIZE bytes
+# per direction; the socket only carries their position. Pickled packets
+# are not worth the extra copy.
+USE_SHM = True
+SHM_SIZE = 64 * 1024 * 1024
+SHM_MIN_SIZE = 256 * 1024
+
+# Packets of at least COMPRESS_MIN_SIZE bytes to remote hosts (and to
+# the local host if COMPRESS_LOCAL is set) are compressed with zlib at
+# COMPRESS_LEVEL, if the peer supports it.
+# Packets with out-of-band arrays are sent as they are: raw numeric data
+# does not compress well enough to be worth the time. A compressed packet
+# is only sent if it saves at least 10%.
+COMPRESS_LEVEL = 1
+COMPRESS_MIN_SIZE = 64 * 1024
+COMPRESS_LOCAL = False
+
+# Socket errors meaning 'no data available now'
+_EAGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, 10035)
+
 class RemoteException(Exception):
     pass
 
+class _Packet():
+    '''
+    A received packet: <length> bytes at <start> in bytearray <buf>.
+    <magic> is 'QT' for plain packets, 'QA' for packets with out-of-band
+    arrays, 'QS' for packets passed through shared memory and 'QZ' for
+    compressed packets. If <owned> is True the memory is not reused by
+    the receive buffer.
+    '''
+
+    def __init__(self, magic, buf, start, length, owned):
+        self.magic = magic
+        self.buf = buf
+        self.start = start
+        self.length = length
+        self.owned = owned
+
+    def get_view(self, offset=0, length=None):
+        if length is None:
+            length = self.length - offset
+        start = self.start + offset
+        return memoryview(self.buf)[start:start + length]
+
+class _ReceiveBuffer():
+    '''
+    Reassembly buffer for the packets of one connection.
+
+    Data is received directly into a bytearray with recv_into; packets are
+    returned as memoryviews on that buffer. Once the header of a packet is
+    in, the buffer is grown to hold the complete packet so that it is
+    received without further copies. The buffer of a large packet is given
+    to that packet and a new one is started, so the packet data stays
+    valid after the next receive.
+    '''
+
+    HEADER_LEN = 6
+
+    def __init__(self):
+        self._buf = bytearray(RECV_MIN)
+        self._start = 0
+        self._end = 0
+        self._recvsize = RECV_MIN
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        self._start = 0
+        self._end = 0
+
+    def _reserve(self, n):
+        if self._end + n <= len(self._buf):
+            return
+
+        used = self._end - self._start
+        if self._start > 0 and used + n <= len(self._buf):
+            self._buf[0:used] = self._buf[self._start:self._end]
+        else:
+            newbuf = bytearray(max(2 * len(self._buf), used + n))
+            newbuf[0:used] = self._buf[self._start:self._end]
+            self._buf = newbuf
+        self._start = 0
+        self._end = used
+
+    def _get_missing(self):
+        '''Return number of bytes missing for the current packet.'''
+        used = self._end - self._start
+        if used < self.HEADER_LEN:
+            return self.HEADER_LEN - used
+        datalen, = struct.unpack_from('>I', self._buf, self._start + 2)
+        return max(0, self.HEADER_LEN + datalen - used)
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def recv(self, sock):
+        '''
+        Receive data from <sock>, return the number of bytes (0 if the
+        connection was closed).
+        '''
+
+        n = max(self._recvsize, self._get_missing())
+        self._reserve(n)
+        nrecv = sock.recv_into(memoryview(self._buf)[self._end:], n)
+        self._end += nrecv
+
+        if nrecv == self._recvsize and self._recvsize < RECV_MAX:
+            self._recvsize *= 2
+        elif nrecv < self._recvsize / 4 and self._recvsize > RECV_MIN:
+            self._recvsize /= 2
+
+        return nrecv
+
+    def get_packet(self):
+        '''
+        Return the next complete packet (a _Packet), None if there is
+        none. Raises ValueError if the data is not a packet.
+        '''
+
+        used = self._end - self._start
+        if used < self.HEADER_LEN:
+            return None
+        magic = str(self._buf[self._start:self._start + 2])
+        if magic not in ('QT', 'QA', 'QS', 'QZ'):
+            self.clear()
+            raise ValueError('Packet magic missing')
+
+        datalen, = struct.unpack_from('>I', self._buf, self._start + 2)
+        total = self.HEADER_LEN + datalen
+        if used < total:
+            return None
+
+        # Arrays in 'QA' packets refer to the packet memory, so always
+        # hand the buffer over to those
+        owned = (datalen >= LARGE_PACKET or magic == 'QA')
+        packet = _Packet(magic, self._buf, self._start + self.HEADER_LEN,
+                datalen, owned)
+        self._start += total
+
+        if self._start == self._end:
+            self._start = self._end = 0
+            if owned:
+                self._buf = bytearray(RECV_MIN)
+        elif owned:
+            rest = self._buf[self._start:self._end]
+            self._buf = bytearray(max(RECV_MIN, len(rest)))
+            self._buf[0:len(rest)] = rest
+            self._start = 0
+            self._end = len(rest)
+
+        return packet
+
+class _SharedRing():
+    '''
+    Ring buffer in a memory mapped temporary file, used to pass large
+    packets to a peer on the same host.
+
+    The sending side creates the file and writes packets; the peer maps
+    the same file and copies packets out at the positions announced on
+    the socket. Positions only increase; the offset in the ring is the
+    position modulo the size. The header contains the read position,
+    updated by the reader, so the writer knows which space is free.
+    '''
+
+    HEADER = 64
+
+    def __init__(self, fd, path, size):
+        self._path = path
+        self._size = size
+        self._mmap = mmap.mmap(fd, self.HEADER + size)
+        os.close(fd)
+        self._data = numpy.frombuffer(self._mmap, numpy.uint8, size,
+                self.HEADER)
+        self._write_pos = 0
+
+    @staticmethod
+    def create(size):
+        fd, path = tempfile.mkstemp(prefix='qtlab_shm_')
+        os.lseek(fd, _SharedRing.HEADER + size - 1, 0)
+        os.write(fd, '\0')
+        return _SharedRing(fd, path, size)
+
+    @staticmethod
+    def open(path, size):
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        if os.fstat(fd).st_size < _SharedRing.HEADER + size:
+            os.close(fd)
+            raise ValueError('Shared memory file %s too small' % path)
+        return _SharedRing(fd, path, size)
+
+    def get_path(self):
+        return self._path
+
+    def unlink(self):
+        '''
+        Remove the file; the mapping stays valid. Windows does not allow
+        removing a mapped file, close() tries again.
+        '''
+
+        if self._path is None:
+            return True
+        try:
+            os.unlink(self._path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.debug('Unable to remove %s: %s', self._path, e)
+                return False
+        self._path = None
+        return True
+
+    def close(self):
+        self._data = None
+        self._mmap.close()
+        if not self.unlink():
+            logging.warning('Unable to remove shared memory file %s',
+                    self._path)
+
+    def write(self, parts, length):
+        '''
+        Copy <parts> (strings or uint8 arrays, <length> bytes in total)
+        into the ring. Returns the position, or None if there is no space.
+        '''
+
+        read_pos, = struct.unpack_from('>Q', self._mmap, 0)
+        if length > self._size - (self._write_pos - read_pos):
+            return None
+
+        start = self._write_pos
+        pos = start
+        for part in parts:
+            if len(part) == 0:
+                continue
+            data = numpy.frombuffer(part, numpy.uint8)
+            off = pos % self._size
+            n = min(len(data), self._size - off)
+            self._data[off:off + n] = data[:n]
+            if n < len(data):
+                self._data[:len(data) - n] = data[n:]
+            pos += len(data)
+
+        self._write_pos = pos
+        return start
+
+    def read(self, pos, length):
+        '''
+        Copy <length> bytes at <pos> out of the ring into a new bytearray
+        and free the space.
+        '''
+
+        buf = bytearray(length)
+        dst = numpy.frombuffer(buf, numpy.uint8)
+        off = pos % self._size
+        n = min(length, self._size - off)
+        dst[:n] = self._data[off:off + n]
+        if n < length:
+            dst[n:] = self._data[:length - n]
+        struct.pack_into('>Q', self._mmap, 0, pos + length)
+        return buf
+
+def _is_local_connection(conn):
+    '''Return whether the peer of socket <conn> is on this host.'''
+    try:
+        if conn.family == getattr(socket, 'AF_UNIX', None):
+            return True
+        peer = conn.getpeername()[0]
+        local = conn.getsockname()[0]
+    except Exception:
+        return False
+    return peer == local or peer.startswith('127.') or peer == '::1'
+
 class ObjectSharer():
     '''
     The object sharer containing both client and server functions.
@@ -57,7 +376,9 @@ class ObjectSharer():
 
         self._client_timeout = 60
 
-        # Store callback info indexed on hid and on signam__objname
+        # Signal callbacks: hid -> (key, function, args, kwargs) and
+        # key -> OrderedDict of hid -> (function, args, kwargs), where key
+        # is (objname, signame)
         self._callbacks_hid = {}
         self._callbacks_name = {}
         self._event_callbacks = {}
@@ -65,6 +386,37 @@ class ObjectSharer():
         # Buffers to store partly received packets
         self._buffers = {}
         self._send_queue = {}
+        self._send_queue_size = {}
+
+        # Coalesced signals waiting for the send queue to drain:
+        # conn -> OrderedDict of (objname, signame) -> (args, kwargs)
+        self._pending_signals = {}
+        self._send_stats = {}
+        self._send_blocked = set()
+
+        # Capabilities of peers, per connection
+        self._capabilities = {}
+
+        # Shared memory rings for peers on the same host, per connection
+        self._shm_writers = {}
+        self._shm_readers = {}
+
+        # Compression level per connection
+        self._compress = {}
+
+        # Signals peers are interested in: conn -> set of (objname, signame)
+        self._subscriptions = {}
+        # Signals of remote objects we have handlers for:
+        # (conn, objname, signame) -> number of handlers, and hid -> key
+        self._subscribed = {}
+        self._subscribed_hids = {}
+
+        # Connection of the request being handled
+        self._caller = None
+
+        # Cached proxy functions to clear on a signal:
+        # (conn, objname, signame) -> list of _FunctionCall
+        self._cache_watches = {}
 
     def set_client_timeout(self, timeout):
         '''
@@ -82,6 +434,13 @@ class ObjectSharer():
             logging.warning('Unable to get client root object')
             return None
         client = ObjectProxy(conn, info)
+        if hasattr(client, 'get_capabilities'):
+            caps = client.get_capabilities()
+            self._capabilities[conn] = set(caps or [])
+            self._setup_shm(conn, client)
+            if 'zlib' in self._capabilities[conn] and (COMPRESS_LOCAL or \
+                    not _is_local_connection(conn)):
+                self.set_compression(conn, COMPRESS_LEVEL)
         self._clients.append(client)
         name = client.get_instance_name()
         logging.info('Added client %r, name %s', client.get_id(), name)
@@ -105,6 +464,9 @@ class ObjectSharer():
         Register callback cb for event. Event is one of:
         - connect: client connected
         - disconnect: client disconnected
+        - send-blocked: data for a connection could not be sent
+          completely; the callback gets the connection and should call
+          _process_send_queue(conn) when it becomes writable
         '''
 
         if event in self._event_callbacks:
@@ -125,8 +487,111 @@ class ObjectSharer():
                 self.remove_client(client)
                 break
 
-        if conn in self._send_queue:
-            del self._send_queue[conn]
+        for d in (self._send_queue, self._send_queue_size,
+                self._pending_signals, self._send_stats):
+            if conn in d:
+                del d[conn]
+        self._send_blocked.discard(conn)
+        self._remove_cache_watches(conn)
+        if conn in self._buffers:
+            del self._buffers[conn]
+        if conn in self._capabilities:
+            del self._capabilities[conn]
+        if conn in self._subscriptions:
+            del self._subscriptions[conn]
+        if conn in self._compress:
+            del self._compress[conn]
+        for rings in (self._shm_writers, self._shm_readers):
+            if conn in rings:
+                rings.pop(conn).close()
+        for hid, key in self._subscribed_hids.items():
+            if key[0] == conn:
+                del self._subscribed_hids[hid]
+                self._subscribed.pop(key, None)
+
+    def _setup_shm(self, conn, client):
+        '''
+        Create a shared memory ring for sending to a peer on the same host
+        and ask the peer to map it.
+        '''
+
+        if not USE_SHM or not self.has_capability(conn, 'shm') or \
+                not _is_local_connection(conn):
+            return
+
+        try:
+            ring = _SharedRing.create(SHM_SIZE)
+        except Exception, e:
+            logging.warning('Unable to create shared memory buffer: %s', e)
+            return
+
+        try:
+            ok = client.attach_shm(ring.get_path(), SHM_SIZE)
+        except Exception, e:
+            ok = False
+
+        if ok:
+            # Both sides have it mapped now
+            ring.unlink()
+            self._shm_writers[conn] = ring
+            logging.debug('Using shared memory for large packets')
+        else:
+            ring.close()
+
+    def set_compression(self, conn, level):
+        '''
+        Compress large packets sent on <conn> with zlib level <level>
+        (1-9), or disable compression for <conn> with level 0. Only use
+        this for peers with the 'zlib' capability.
+        '''
+
+        if level > 0:
+            self._compress[conn] = level
+        elif conn in self._compress:
+            del self._compress[conn]
+
+    def _compress_packet(self, conn, data):
+        '''
+        Return compressed version of packet data <data> for <conn>, or
+        None if it is not worth it.
+        '''
+
+        stats = self._get_send_stats(conn)
+        start = time.time()
+        zdata = zlib.compress(data, self._compress[conn])
+        stats['compress_time'] += time.time() - start
+
+        if len(zdata) > 0.9 * len(data):
+            stats['compress_skipped'] += 1
+            return None
+
+        stats['compressed'] += 1
+        stats['compress_saved'] += len(data) - len(zdata)
+        return zdata
+
+    def _decompress_packet(self, conn, packet):
+        stats = self._get_send_stats(conn)
+        start = time.time()
+        data = zlib.decompress(buffer(packet.buf, packet.start, packet.length))
+        stats['decompress_time'] += time.time() - start
+        return _Packet('QT', data, 0, len(data), True)
+
+    def attach_shm(self, conn, path, size):
+        '''Map the shared memory ring the peer on <conn> sends through.'''
+        try:
+            self._shm_readers[conn] = _SharedRing.open(path, size)
+            return True
+        except Exception, e:
+            logging.warning('Unable to map shared memory %s: %s', path, e)
+            return False
+
+    def has_capability(self, conn, name):
+        '''Return whether the peer on <conn> supports feature <name>.'''
+        return name in self._capabilities.get(conn, ())
+
+    def get_caller(self):
+        '''Return the connection of the remote request being handled.'''
+        return self._caller
 
     def get_clients(self):
         return self._clients
@@ -254,64 +719,194 @@ class ObjectSharer():
 
         return self.find_remote_object(objname)
 
-    def _pickle_packet(self, info, data):
+    def _pickle_packet(self, info, data, conn=None):
+        '''
+        Encode a packet. If the peer on <conn> supports it, large numpy
+        arrays are sent out of band; a list of parts is returned then.
+        '''
+
+        if conn is not None and self.has_capability(conn, 'oob_arrays'):
+            try:
+                return self._pickle_oob((info, data))
+            except Exception, e:
+                pass
+
         try:
-            retdata = pickle.dumps((info, data))
+            retdata = pickle.dumps((info, data), pickle.HIGHEST_PROTOCOL)
         except Exception, e:
             msg = 'Unable to encode object: %s' % str(e)
-            retdata = pickle.dumps((info, msg))
+            retdata = pickle.dumps((info, msg), pickle.HIGHEST_PROTOCOL)
         return retdata
 
+    def _pickle_oob(self, obj):
+        '''
+        Pickle <obj>, storing numpy arrays as references to raw data that
+        follows the pickle. Returns the pickle string if there are no such
+        arrays, otherwise a list of parts: pickle length and pickle, then
+        the array data as uint8 arrays (without copying).
+        '''
+
+        arrays = []
+        offset = [0]
+
+        def persistent_id(o):
+            if type(o) is not numpy.ndarray or o.nbytes < OOB_MIN_SIZE \
+                    or o.dtype.hasobject:
+                return None
+
+            if o.flags.c_contiguous:
+                order = 'C'
+            elif o.flags.f_contiguous:
+                order = 'F'
+            else:
+                o = numpy.ascontiguousarray(o)
+                order = 'C'
+
+            if o.dtype.fields is not None:
+                dtype = o.dtype.descr
+            else:
+                dtype = o.dtype.str
+
+            pid = ('ndarray', offset[0], dtype, o.shape, order)
+            arrays.append(o.reshape(-1, order=order).view(numpy.uint8))
+            offset[0] += o.nbytes
+            return pid
+
+        f = StringIO()
+        p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        p.persistent_id = persistent_id
+        p.dump(obj)
+        data = f.getvalue()
+
+        if len(arrays) == 0:
+            return data
+        return [struct.pack('>I', len(data)) + data] + arrays
+
+    def _decode_packet(self, packet):
+        '''Decode a received _Packet.'''
+
+        if packet.magic != 'QA':
+            return self._unpickle_packet(packet.get_view())
+
+        plen, = struct.unpack_from('>I', packet.buf, packet.start)
+        base = packet.start + 4 + plen
+
+        def persistent_load(pid):
+            kind, offset, dtype, shape, order = pid
+            dtype = numpy.dtype(dtype)
+            count = 1
+            for n in shape:
+                count *= n
+            arr = numpy.frombuffer(packet.buf, dtype, count, base + offset)
+            arr = arr.reshape(shape, order=order)
+            if not packet.owned:
+                arr = arr.copy()
+            return arr
+
+        try:
+            u = pickle.Unpickler(StringIO(packet.get_view(4, plen)))
+            u.persistent_load = persistent_load
+            return u.load()
+        except Exception, e:
+            logging.warning('Unable to decode object: %s', str(e))
+            raise e
+
+    def _read_shm_packet(self, conn, packet):
+        '''Copy the packet announced by 'QS' <packet> out of shared memory.'''
+        magic, pos, length = struct.unpack_from('>2sQI', packet.buf,
+                packet.start)
+        buf = self._shm_readers[conn].read(pos, length)
+        return _Packet(magic, buf, 0, length, True)
+
     def _unpickle_packet(self, data):
+        # <data> can be a memoryview; read it through a file object to
+        # avoid copying it into a string first.
         try:
-            return pickle.loads(data)
+            return pickle.Unpickler(StringIO(data)).load()
         except Exception, e:
-            logging.warning('Unable to decode object: %s [%r]', str(e), data)
+            logging.warning('Unable to decode object: %s [%r]', str(e),
+                    str(data[:64]))
             raise e
 
     def _send_return(self, conn, callid, retval):
         logging.debug('Returning for call %d: %r', callid, retval)
         retinfo = ('return', callid)
-        retdata = self._pickle_packet(retinfo, retval)
+        retdata = self._pickle_packet(retinfo, retval, conn)
         self.send_packet(conn, retdata)
 
+    def _get_buffer(self, conn):
+        if conn not in self._buffers:
+            self._buffers[conn] = _ReceiveBuffer()
+        return self._buffers[conn]
+
     def handle_data(self, conn, data):
         '''
-        Handle incoming data from a connection and produce packets in the
-        packet queue. If a response is not expected, process the packet
-        immediately.
+        Handle incoming data from a connection and process complete
+        packets.
         '''
 
-        if conn not in self._buffers:
-            self._buffers[conn] = ''
+        self._get_buffer(conn).feed(data)
+        self._process_buffer(conn)
+
+    def receive(self, conn):
+        '''
+        Receive available data from connection <conn> and process complete
+        packets. Use this instead of recv() + handle_data() to avoid
+        copying the data.
+
+        Output: False if the connection was closed, True otherwise.
+        '''
+
+        buf = self._get_buffer(conn)
+        try:
+            n = buf.recv(conn)
+        except socket.error, e:
+            if e.errno in _EAGAIN:
+                return True
+            logging.warning('Receive exception (%s), assuming client '
+                    'disconnected', e)
+            self._client_disconnected(conn)
+            return False
 
-        self._buffers[conn] = self._buffers[conn] + data
+        if n == 0:
+            self._client_disconnected(conn)
+            return False
 
-        # Decode complete packets
-        while len(self._buffers[conn]) >= 6:
-            b = self._buffers[conn]
+        self._process_buffer(conn)
+        return True
 
-            if b[0] != 'Q' or b[1] != 'T':
-                self._buffers[conn] = ''
+    def _process_buffer(self, conn):
+        # Packets are handled one by one; handling can receive more data
+        # for this connection (e.g. during a blocking call).
+        while conn in self._buffers:
+            try:
+                packet = self._buffers[conn].get_packet()
+            except ValueError, e:
                 logging.warning('Packet magic missing, dumping data')
                 return None
-
-            datalen = (ord(b[2]) << 24) + (ord(b[3]) << 16) + (ord(b[4]) << 8)  + ord(b[5])
-            if len(b) < datalen + 6:
-                logging.debug('Incomplete packet received')
+            if packet is None:
                 return None
 
-            packet = b[6:6+datalen]
-            self._buffers[conn] = b[6+datalen:]
-
             try:
-                packet = self._unpickle_packet(packet)
+                if packet.magic == 'QS':
+                    packet = self._read_shm_packet(conn, packet)
+                if packet.magic == 'QZ':
+                    packet = self._decompress_packet(conn, packet)
+                packet = self._decode_packet(packet)
             except Exception, e:
                 logging.warning('Unable to unpickle packet')
                 return
 
             self.handle_packet(conn, packet)
 
+    def _resolve_return(self, val):
+        '''Replace a shared object reference in a return value by a proxy.'''
+        if type(val) == types.StringType and val.startswith('sharedname:'):
+            sn = val[11:]
+            logging.debug('Received shared object reference, finding %s', sn)
+            return helper.find_object(sn)
+        return val
+
     def handle_packet(self, conn, packet):
         '''
         Process an incoming packet
@@ -329,101 +924,290 @@ class ObjectSharer():
 
             func = self._return_cbs[callid]
             del self._return_cbs[callid]
+            func(self._resolve_return(callinfo))
+            return
 
-            if type(callinfo) == types.StringType and callinfo.startswith('sharedname:'):
-                sn = callinfo[11:]
-                logging.debug('Received shared object reference, finding %s', sn)
-                callinfo = helper.find_object(sn)
-
-            func(callinfo)
+        elif info[0] == 'calls':
+            # Batch of calls, reply with a list of return values
+            rets = [self._do_call(conn, *c) for c in callinfo]
+            self._send_return(conn, info[1], rets)
             return
 
         elif info[0] not in ('call', 'signal'):
             logging.warning('Invalid request: %r, %r', info, callinfo)
             return False
 
-        (objname, funcname, args, kwargs) = callinfo
-        logging.debug('Handling: %s.%s(%r, %r)', objname, funcname, args, kwargs)
+        ret = self._do_call(conn, *callinfo)
+        if info[0] == 'signal':
+            # No need to send return
+            return
+
+        self._send_return(conn, info[1], ret)
+
+    def _do_call(self, conn, objname, funcname, args, kwargs):
+        '''
+        Call a function of a local object for a remote request. Returns
+        the value to send back: the return value, an exception or a
+        reference to a shared object.
+        '''
+
+        logging.debug('Handling: %s.%s(%r, %r)', objname, funcname, args,
+                kwargs)
         if objname not in self._objects:
             msg = 'Object %s not available' % objname
             logging.warning(msg)
-            if info[0] != 'signal':
-                self._send_return(conn, info[1], ValueError(msg))
-            return None
+            return ValueError(msg)
 
         obj = self._objects[objname]
-        func = getattr(obj, funcname)
+        prev_caller = self._caller
+        self._caller = conn
         try:
+            func = getattr(obj, funcname)
             ret = func(*args, **kwargs)
         except Exception, e:
             import traceback
             tb = traceback.format_exc(15)
             ret = RemoteException('%s\n%s' % (e, tb))
-
-        if info[0] == 'signal':
-            # No need to send return
-            return
+        self._caller = prev_caller
 
         if isinstance(ret, SharedObject):
             sn = root.get_instance_name() + ':' + ret.get_shared_name()
             logging.debug('Returning a shared object reference: %s', sn)
             ret = 'sharedname:' + sn
 
-        self._send_return(conn, info[1], ret)
+        return ret
 
     def _do_send_raw(self, conn, data):
         try:
             ret = conn.send(data)
         except socket.error, e:
-            if e.errno not in (10035, ):
-                logging.warning('Send exception (%s), assuming client disconnected', e)
+            if e.errno not in _EAGAIN:
+                logging.warning('Send exception (%s), assuming client '
+                        'disconnected', e)
                 self._client_disconnected(conn)
                 return -1
             ret = 0
 
         return ret
 
-    def _process_send_queue(self):
+    def _get_send_stats(self, conn):
+        if conn not in self._send_stats:
+            self._send_stats[conn] = {
+                'bytes_sent': 0,
+                'packets_sent': 0,
+                'max_queued': 0,
+                'dropped': 0,
+                'coalesced': 0,
+                'shm_bytes': 0,
+                'compressed': 0,
+                'compress_skipped': 0,
+                'compress_saved': 0,
+                'compress_time': 0.0,
+                'decompress_time': 0.0,
+            }
+        return self._send_stats[conn]
+
+    def _process_send_queue(self, conn=None):
         '''
-        Process send queue on a per connection basis.
+        Send queued data, for connection <conn> or for all connections.
+        When the queue of a connection is empty, coalesced signals for it
+        are sent.
         '''
 
-        for conn in self._send_queue.keys():
-            datalist = self._send_queue[conn]
-            while len(datalist) > 0:
+        if conn is None:
+            conns = self._send_queue.keys()
+        else:
+            conns = [conn]
+
+        for conn in conns:
+            datalist = self._send_queue.get(conn)
+            while datalist:
                 nsent = self._do_send_raw(conn, datalist[0])
 
+                # Failed, signals disconnection so remove send queue
+                if nsent == -1:
+                    break
+
+                self._send_queue_size[conn] -= nsent
+                self._get_send_stats(conn)['bytes_sent'] += nsent
+
                 # Ok
                 if nsent == len(datalist[0]):
                     del datalist[0]
+                    if len(datalist) == 0:
+                        self._flush_pending_signals(conn)
 
-                # Failed, signals disconnection so remove send queue
-                elif nsent == -1:
-                    if conn in self._send_queue:
-                        del self._send_queue[conn]
+                # Partially sent; continue later without copying the data
+                elif isinstance(datalist[0], numpy.ndarray):
+                    datalist[0] = datalist[0][nsent:]
                     break
-
-                # Partially sent
                 else:
-                    datalist[0] = datalist[0][nsent:]
+                    datalist[0] = memoryview(datalist[0])[nsent:]
                     break
 
+            if not datalist:
+                self._send_blocked.discard(conn)
+            elif conn not in self._send_blocked:
+                self._send_blocked.add(conn)
+                self._do_event_callbacks('send-blocked', conn)
+
         return True
 
-    def send_packet(self, conn, data):
-        dlen = len(data)
+    def _queue_packet(self, conn, data):
+        '''
+        Add packet <data> to the send queue of <conn>: a string, or a list
+        of parts as returned by _pickle_oob().
+        '''
+
+        if type(data) is types.ListType:
+            magic = 'QA'
+            parts = data
+        else:
+            magic = 'QT'
+            parts = [data]
+
+        dlen = sum([len(part) for part in parts])
         if dlen > 0xffffffffL:
             logging.error('Trying to send too long packet: %d', dlen)
-            return -1
+            return False
 
-        tosend = 'QT%c%c%c%c' % ((dlen&0xff000000)>>24, \
-            (dlen&0x00ff0000)>>16, (dlen&0x0000ff00)>>8, (dlen&0x000000ff))
-        tosend += data
+        if magic == 'QT' and conn in self._compress and \
+                dlen >= COMPRESS_MIN_SIZE:
+            zdata = self._compress_packet(conn, data)
+            if zdata is not None:
+                magic = 'QZ'
+                parts = [zdata]
+                dlen = len(zdata)
+
+        # Pass large arrays through shared memory if possible
+        ring = self._shm_writers.get(conn)
+        if ring is not None and magic == 'QA' and dlen >= SHM_MIN_SIZE:
+            pos = ring.write(parts, dlen)
+            if pos is not None:
+                self._get_send_stats(conn)['shm_bytes'] += dlen
+                parts = [struct.pack('>2sQI', magic, pos, dlen)]
+                magic = 'QS'
+                dlen = len(parts[0])
+
+        header = struct.pack('>2sI', magic, dlen)
+        if len(parts[0]) < RECV_MIN:
+            parts = [header + parts[0]] + parts[1:]
+        else:
+            parts = [header] + parts
 
         if conn not in self._send_queue:
             self._send_queue[conn] = []
-        self._send_queue[conn].append(tosend)
-        self._process_send_queue()
+            self._send_queue_size[conn] = 0
+        self._send_queue[conn].extend(parts)
+        self._send_queue_size[conn] += len(header) + dlen
+
+        stats = self._get_send_stats(conn)
+        stats['packets_sent'] += 1
+        stats['max_queued'] = max(stats['max_queued'],
+                self._send_queue_size[conn])
+        return True
+
+    def send_packet(self, conn, data):
+        '''
+        Send packet <data> on <conn>: a string, or a list of parts as
+        returned by _pickle_oob().
+        '''
+
+        if not self._queue_packet(conn, data):
+            return -1
+        self._process_send_queue(conn)
+
+        # Arrays can change after returning, copy what was not sent yet
+        queue = self._send_queue.get(conn, [])
+        for i, part in enumerate(queue):
+            if isinstance(part, numpy.ndarray):
+                queue[i] = part.tostring()
+
+    def is_behind(self, conn):
+        '''Return whether data for <conn> is waiting to be sent.'''
+        return len(self._send_queue.get(conn, ())) > 0
+
+    def _send_signal(self, conn, objname, signame, args, kwargs, packets):
+        '''
+        Send a signal to <conn>. Encoded packets are stored in <packets>
+        to reuse them for other connections.
+        '''
+
+        if signame in COALESCE_SIGNALS and self.is_behind(conn):
+            self._coalesce_signal(conn, objname, signame, args, kwargs)
+            # Send what the socket takes now; this sends the coalesced
+            # signals if the queue drains.
+            self._process_send_queue(conn)
+            return
+
+        if signame not in STRUCTURAL_SIGNALS and \
+                self._send_queue_size.get(conn, 0) >= SEND_QUEUE_LIMIT:
+            self._get_send_stats(conn)['dropped'] += 1
+            return
+
+        oob = self.has_capability(conn, 'oob_arrays')
+        if oob not in packets:
+            callinfo = ('root', 'receive_signal', (objname, signame) + args,
+                    kwargs)
+            packets[oob] = self._pickle_packet(('signal', ), callinfo,
+                    oob and conn or None)
+        self.send_packet(conn, packets[oob])
+
+    def _coalesce_signal(self, conn, objname, signame, args, kwargs):
+        if conn not in self._pending_signals:
+            self._pending_signals[conn] = OrderedDict()
+        pending = self._pending_signals[conn]
+
+        key = (objname, signame)
+        if key in pending:
+            self._get_send_stats(conn)['coalesced'] += 1
+            prev_args, prev_kwargs = pending[key]
+            if len(args) > 0 and len(args) == len(prev_args) and \
+                    type(args[-1]) is dict and type(prev_args[-1]) is dict:
+                merged = dict(prev_args[-1])
+                merged.update(args[-1])
+                args = args[:-1] + (merged, )
+        pending[key] = (args, kwargs)
+
+    def _flush_pending_signals(self, conn):
+        pending = self._pending_signals.pop(conn, None)
+        if not pending:
+            return
+
+        # Pickle arrays inline: this can run from a timer, after which
+        # nothing copies array parts that are still queued.
+        for (objname, signame), (args, kwargs) in pending.iteritems():
+            callinfo = ('root', 'receive_signal', (objname, signame) + args,
+                    kwargs)
+            self._queue_packet(conn, self._pickle_packet(('signal', ),
+                    callinfo))
+
+    def get_send_statistics(self):
+        '''
+        Return dictionary of peer address -> transfer statistics:
+            bytes_sent, packets_sent: totals for the connection
+            queued: bytes waiting to be sent now
+            max_queued: maximum number of bytes waiting to be sent
+            dropped: signals dropped because the queue was full
+            coalesced: signals replaced by a later one
+            shm_bytes: bytes passed through shared memory
+            compressed: packets sent compressed
+            compress_skipped: packets sent as is because they did not
+                compress well
+            compress_saved: bytes saved by compression
+            compress_time, decompress_time: time (s) spent compressing
+                sent and decompressing received packets
+        '''
+
+        ret = {}
+        for conn, stats in self._send_stats.items():
+            try:
+                name = '%s:%d' % conn.getpeername()[:2]
+            except Exception:
+                name = repr(conn)
+            ret[name] = dict(stats)
+            ret[name]['queued'] = self._send_queue_size.get(conn, 0)
+        return ret
 
     def _call_cb(self, callid, val):
         if callid in self._return_vals:
@@ -448,17 +1232,19 @@ class ObjectSharer():
             if cb is not None:
                 self._return_cbs[callid] = cb
             else:
-                self._return_cbs[callid] = lambda val: self._call_cb(callid, val)
+                self._return_cbs[callid] = \
+                        lambda val: self._call_cb(callid, val)
 
             info = ('call', callid)
         else:
             cb = None
             info = ('signal', )
 
-        logging.debug('Calling %s.%s(%r, %r), info=%r, blocking=%r', objname, funcname, args, kwargs, info, blocking)
+        logging.debug('Calling %s.%s(%r, %r), info=%r, blocking=%r',
+                objname, funcname, args, kwargs, info, blocking)
 
         callinfo = (objname, funcname, args, kwargs)
-        cmd = self._pickle_packet(info, callinfo)
+        cmd = self._pickle_packet(info, callinfo, conn)
         start_time = time.time()
         self.send_packet(conn, cmd)
 
@@ -466,27 +1252,8 @@ class ObjectSharer():
             return
 
         # Wait for return
-        while time.time() - start_time < timeout:
-            if callid in self._return_vals:
-                break
-
-            # Don't depend on a main loop to receive data while blocking
-            import select
-            lists = select.select([conn], [], [], 0.1)
-            if len(lists[0]) > 0:
-                try:
-                    data = conn.recv(BUFSIZE)
-                except:
-                    # Cope with strange windows errors?
-                    time.sleep(0.002)
-                    continue
-
-                if len(data) == 0:
-                    self._client_disconnected(conn)
-                    return
-                self.handle_data(conn, data)
-            else:
-                time.sleep(0.002)
+        self._wait([conn], lambda: callid in self._return_vals,
+                start_time + timeout)
 
         if callid in self._return_vals:
             ret = self._return_vals[callid]
@@ -500,70 +1267,268 @@ class ObjectSharer():
 
         return None
 
+    def _wait(self, conns, done, deadline):
+        '''
+        Receive data on <conns> until done() returns True or time.time()
+        passes <deadline>. Returns done().
+
+        This blocks in select() for the remaining time, so a reply is
+        handled as soon as it arrives. Queued outgoing data for <conns> is
+        sent meanwhile, the peer may need it to reply.
+        '''
+
+        # Don't depend on a main loop to receive data while blocking
+        while not done() and len(conns) > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            wlist = [c for c in conns if self._send_queue.get(c)]
+            try:
+                rlist, wlist, xlist = select.select(conns, wlist, [],
+                        remaining)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if len(wlist) > 0:
+                self._process_send_queue()
+            for conn in rlist:
+                try:
+                    if not self.receive(conn):
+                        conns = [c for c in conns if c is not conn]
+                except:
+                    # Cope with strange windows errors?
+                    time.sleep(0.002)
+
+        return done()
+
+    def call_many(self, conn, calls, callback=None, timeout=None):
+        '''
+        Call several functions through connection <conn> with a single
+        request; the peer replies with all return values in one packet.
+        Peers without support for this get the calls pipelined, i.e. all
+        sent before waiting for the replies.
+
+        Input:
+            calls: list of (objname, funcname, args, kwargs) tuples
+            callback: function to call with the list of return values. If
+                given, call_many() returns immediately.
+            timeout: maximum time to wait for the results
+        Output:
+            List of return values, in the order of <calls>. A call that
+            raised an exception has that exception in its place. None if
+            the calls timed out.
+        '''
+
+        if timeout is None:
+            timeout = self.TIMEOUT
+        calls = [(o, f, tuple(a), dict(k)) for o, f, a, k in calls]
+
+        result = []
+        if callback is None:
+            callback = result.append
+            blocking = True
+        else:
+            blocking = False
+
+        start_time = time.time()
+        if len(calls) == 0:
+            callback([])
+        elif self.has_capability(conn, 'batch_calls'):
+            self._last_call_id += 1
+            callid = self._last_call_id
+            self._return_cbs[callid] = lambda vals: \
+                    callback([self._resolve_return(v) for v in vals])
+            cmd = self._pickle_packet(('calls', callid), calls, conn)
+            self.send_packet(conn, cmd)
+        else:
+            self._call_pipelined(conn, calls, callback)
+
+        if not blocking:
+            return None
+
+        if self._wait([conn], lambda: len(result) > 0, start_time + timeout):
+            return result[0]
+        logging.warning('Batch of %d calls timed out', len(calls))
+        return None
+
+    def _call_pipelined(self, conn, calls, callback):
+        retvals = [None] * len(calls)
+        pending = [len(calls)]
+
+        def store_return(i, val):
+            retvals[i] = val
+            pending[0] -= 1
+            if pending[0] == 0:
+                callback(retvals)
+
+        for i, (objname, funcname, args, kwargs) in enumerate(calls):
+            kwargs = dict(kwargs)
+            kwargs['callback'] = lambda val, i=i: store_return(i, val)
+            self.call(conn, objname, funcname, *args, **kwargs)
+
     def connect(self, objname, signame, callback, *args, **kwargs):
         '''
         Called by ObjectProxy instances to register a callback request.
+        The callback is called with the signal arguments followed by
+        <args>, and the signal keyword arguments updated with <kwargs>.
         '''
+
         self._last_hid += 1
-        info = {
-                'hid': self._last_hid,
-                'object': objname,
-                'signal': signame,
-                'function': callback,
-                'args': args,
-                'kwargs': kwargs,
-        }
+        hid = self._last_hid
+        key = (objname, signame)
+        entry = (callback, args, kwargs)
 
-        self._callbacks_hid[self._last_hid] = info
-        name = '%s__%s' % (objname, signame)
-        if name in self._callbacks_name:
-            self._callbacks_name[name].append(info)
-        else:
-            self._callbacks_name[name] = [info]
+        self._callbacks_hid[hid] = (key, ) + entry
+        if key not in self._callbacks_name:
+            self._callbacks_name[key] = OrderedDict()
+        self._callbacks_name[key][hid] = entry
 
-        return self._last_hid
+        return hid
 
     def disconnect(self, hid):
-        if hid in self._callbacks_hid:
-            del self._callbacks_hid[hid]
+        info = self._callbacks_hid.pop(hid, None)
+        if info is not None:
+            key = info[0]
+            entries = self._callbacks_name[key]
+            del entries[hid]
+            if len(entries) == 0:
+                del self._callbacks_name[key]
+
+        if hid in self._subscribed_hids:
+            self._unsubscribe(hid)
+
+    def subscribe(self, conn, objname, signame, hid):
+        '''
+        Tell the peer on <conn> that handler <hid> wants signal <signame>
+        of its object <objname>. Called by ObjectProxy.connect().
+        '''
 
-        for name, info_list in self._callbacks_name.iteritems():
-            for index, info in enumerate(info_list):
-                if info['hid'] == hid:
-                    del self._callbacks_name[name][index]
-                    break
+        key = (conn, objname, signame)
+        self._subscribed_hids[hid] = key
+        n = self._subscribed.get(key, 0)
+        self._subscribed[key] = n + 1
+        if n == 0 and self.has_capability(conn, 'signal_subscriptions'):
+            self.call(conn, 'root', 'add_subscription', objname, signame,
+                    signal=True)
+
+    def _unsubscribe(self, hid):
+        key = self._subscribed_hids.pop(hid)
+        n = self._subscribed.get(key, 1) - 1
+        if n > 0:
+            self._subscribed[key] = n
+            return
+
+        self._subscribed.pop(key, None)
+        conn, objname, signame = key
+        if self.has_capability(conn, 'signal_subscriptions'):
+            self.call(conn, 'root', 'remove_subscription', objname, signame,
+                    signal=True)
+
+    def add_subscription(self, conn, objname, signame):
+        '''Send signal <signame> of local object <objname> to <conn>.'''
+        if conn not in self._subscriptions:
+            self._subscriptions[conn] = set()
+        self._subscriptions[conn].add((objname, signame))
+
+    def remove_subscription(self, conn, objname, signame):
+        if conn in self._subscriptions:
+            self._subscriptions[conn].discard((objname, signame))
+
+    def is_subscribed(self, conn, objname, signame):
+        '''
+        Return whether the peer on <conn> wants signal <signame> of
+        <objname>. Peers that do not report their subscriptions get all
+        signals.
+        '''
+        if not self.has_capability(conn, 'signal_subscriptions'):
+            return True
+        return (objname, signame) in self._subscriptions.get(conn, ())
 
     def emit_signal(self, objname, signame, *args, **kwargs):
+        '''
+        Send signal to all clients that are subscribed to it. The packet
+        is encoded once (once per encoding when clients differ in support
+        for out of band arrays). For clients that are behind signals in
+        COALESCE_SIGNALS are coalesced, other signals except
+        STRUCTURAL_SIGNALS are dropped when the send queue reaches
+        SEND_QUEUE_LIMIT.
+        '''
+
+        conns = [client.get_connection() for client in self._clients]
+        conns = [c for c in conns if self.is_subscribed(c, objname, signame)]
         logging.debug('Emitting %s(%r, %r) for %s to %d clients',
-                signame, args, kwargs, objname, len(self._clients))
+                signame, args, kwargs, objname, len(conns))
+        if len(conns) == 0:
+            return
 
-        kwargs['signal'] = True
-        for client in self._clients:
-            client.receive_signal(objname, signame, *args, **kwargs)
+        packets = {}
+        for conn in conns:
+            self._send_signal(conn, objname, signame, args, kwargs, packets)
+
+    def watch_cache(self, conn, objname, signame, func):
+        '''
+        Clear the cached results of _FunctionCall <func> when signal
+        <signame> of remote object <objname> is received.
+        '''
+
+        key = (conn, objname, signame)
+        if key not in self._cache_watches:
+            self._cache_watches[key] = []
+            self._last_hid += 1
+            self.subscribe(conn, objname, signame, self._last_hid)
+        if func not in self._cache_watches[key]:
+            self._cache_watches[key].append(func)
+
+    def _remove_cache_watches(self, conn):
+        for key in self._cache_watches.keys():
+            if key[0] == conn:
+                for func in self._cache_watches.pop(key):
+                    func.clear_cache()
 
     def receive_signal(self, objname, signame, *args, **kwargs):
         logging.debug('Received signal %s(%r, %r) from %s',
                 signame, args, kwargs, objname)
 
+        # Clear caches first, so callbacks get fresh values. Signals
+        # arrive through root.receive_signal, so the caller is the
+        # connection they came from.
+        key = (self._caller, objname, signame)
+        for func in self._cache_watches.get(key, ()):
+            func.clear_cache()
+
+        entries = self._callbacks_name.get((objname, signame))
+        if entries is None:
+            return
+
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            start = time.time()
+
+        # Copy, callbacks can connect or disconnect handlers
         ncalls = 0
-        start = time.time()
-        name = '%s__%s' % (objname, signame)
-        if name in self._callbacks_name:
-            info_list = self._callbacks_name[name]
-            for info in info_list:
-                try:
-                    fargs = list(args)
-                    fargs.extend(info['args'])
-                    fkwargs = kwargs.copy()
-                    fkwargs.update(info['kwargs'])
-                    info['function'](*fargs, **fkwargs)
-                    ncalls += 1
-                except Exception, e:
-                    logging.warning('Callback to %s failed for %s.%s: %s', info['function'], objname, signame, str(e))
-
-        end = time.time()
-        logging.debug('Did %d callbacks in %.03fms for sig %s',
-                ncalls, (end - start) * 1000, signame)
+        for func, fargs, fkwargs in entries.values():
+            try:
+                if fargs:
+                    fargs = args + fargs
+                else:
+                    fargs = args
+                if fkwargs:
+                    if kwargs:
+                        fkwargs = dict(kwargs, **fkwargs)
+                else:
+                    fkwargs = kwargs
+                func(*fargs, **fkwargs)
+                ncalls += 1
+            except Exception, e:
+                logging.warning('Callback to %s failed for %s.%s: %s',
+                        func, objname, signame, str(e))
+
+        if debug:
+            logging.debug('Did %d callbacks in %.03fms for sig %s',
+                    ncalls, (time.time() - start) * 1000, signame)
 
     def close_sockets(self):
         logging.debug('Closing sockets')
@@ -708,18 +1673,72 @@ class _FunctionCall():
         else:
             self._share_options = share_options
 
-        self._cached_result = None
+        self._cache = {}
+        self._generation = 0
 
     def __call__(self, *args, **kwargs):
-        cache = self._share_options.get('cache_result', False) 
-        if cache and self._cached_result is not None:
-            return self._cached_result
-
-        ret = helper.call(self._conn, self._objname, self._funcname, *args, **kwargs)
-        if cache:
-            self._cached_result = ret
+        key = self.get_cache_key(args, kwargs)
+        if self.has_cached_result(key):
+            return self._cache[key]
+
+        generation = self._prepare_call(key)
+        ret = helper.call(self._conn, self._objname, self._funcname,
+                *args, **kwargs)
+        self.set_result(key, ret, generation)
         return ret
 
+    def get_cache_key(self, args, kwargs):
+        '''
+        Return the key to cache the result of a call with <args> and
+        <kwargs>, or None if it should not be cached.
+        '''
+
+        if not self._share_options.get('cache_result', False):
+            return None
+        if 'callback' in kwargs or 'signal' in kwargs:
+            return None
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def has_cached_result(self, key):
+        return key is not None and key in self._cache
+
+    def _prepare_call(self, key):
+        '''
+        Subscribe to the signals that invalidate the result, before the
+        call is sent: the subscription is queued ahead of the call, so the
+        peer sends every signal emitted after it handled the call. The
+        watch is created again if it was dropped (e.g. on disconnect).
+
+        Output: cache generation, to pass to set_result()
+        '''
+
+        if key is not None:
+            for signame in self._share_options.get('invalidate', ()):
+                helper.watch_cache(self._conn, self._objname, signame, self)
+        return self._generation
+
+    def set_result(self, key, ret, generation):
+        '''
+        Store return value <ret> for cache key <key>, unless the cache was
+        cleared since _prepare_call() returned <generation>.
+        '''
+
+        # None can also mean the call timed out
+        if key is None or ret is None or isinstance(ret, Exception):
+            return
+        if generation != self._generation:
+            return
+        self._cache[key] = ret
+
+    def clear_cache(self):
+        self._cache = {}
+        self._generation += 1
+
 class ObjectProxy():
     '''
     Client side object proxy.
@@ -735,7 +1754,8 @@ class ObjectProxy():
         self.__callbacks = {}
 
         for funcname, share_options in info['functions']:
-            setattr(self, funcname, _FunctionCall(self.__conn, self.__name, funcname, share_options))
+            setattr(self, funcname, _FunctionCall(self.__conn, self.__name,
+                    funcname, share_options))
 
         for propname in info['properties']:
             setattr(self, propname, 'blaat')
@@ -744,11 +1764,38 @@ class ObjectProxy():
         return self.__conn
 
     def connect(self, signame, func):
-        return helper.connect(self.__name, signame, func)
+        hid = helper.connect(self.__name, signame, func)
+        helper.subscribe(self.__conn, self.__name, signame, hid)
+        return hid
+
+    def call_many(self, calls, **kwargs):
+        '''
+        Call several functions of the remote object in one request, see
+        ObjectSharer.call_many(). <calls> is a list of function names or
+        (funcname, args) or (funcname, args, kwargs) tuples:
+
+            vals = ins.call_many([('get', ('power',)), ('get', ('freq',))])
+        '''
+
+        full = []
+        for call in calls:
+            if type(call) in types.StringTypes:
+                call = (call, )
+            funcname = call[0]
+            args = len(call) > 1 and call[1] or ()
+            fkwargs = len(call) > 2 and call[2] or {}
+            full.append((self.__name, funcname, args, fkwargs))
+        return helper.call_many(self.__conn, full, **kwargs)
 
     def disconnect(self, hid):
         return helper.disconnect(hid)
 
+    def clear_cache(self):
+        '''Clear cached results of all functions of this proxy.'''
+        for val in self.__dict__.values():
+            if isinstance(val, _FunctionCall):
+                val.clear_cache()
+
     def get_proxy_client(self):
         '''Return the client where this proxy is pointing to'''
         return helper.get_client_for_socket(self.__conn)
@@ -757,9 +1804,120 @@ class ObjectProxy():
         '''Return the connection this proxy is using'''
         return self.__conn
 
-def cache_result(f):
-    f._share_options = {'cache_result': True}
-    return f
+class Batch():
+    '''
+    Collect calls on remote object proxies and execute them with one
+    request per connection:
+
+        with objsh.batch() as b:
+            for name in names:
+                b.add(ins.get, name)
+        vals = b.get_results()
+
+    Results are in the order of the add() calls; a call that raised an
+    exception has that exception in its place.
+    '''
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self._calls = []
+        self._results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, func, *args, **kwargs):
+        '''
+        Add call func(*args, **kwargs), where <func> is a function of an
+        ObjectProxy. Returns the index of the result.
+        '''
+
+        if not isinstance(func, _FunctionCall):
+            raise ValueError('Only functions of remote objects can be batched')
+        self._calls.append((func, args, kwargs))
+        return len(self._calls) - 1
+
+    def execute(self):
+        '''Execute the calls, return list of results.'''
+
+        results = [None] * len(self._calls)
+        generations = [None] * len(self._calls)
+        byconn = {}
+        for i, (func, args, kwargs) in enumerate(self._calls):
+            key = func.get_cache_key(args, kwargs)
+            if func.has_cached_result(key):
+                results[i] = func(*args, **kwargs)
+                continue
+            generations[i] = func._prepare_call(key)
+            if func._conn not in byconn:
+                byconn[func._conn] = []
+            byconn[func._conn].append(i)
+
+        pending = [len(byconn)]
+        def store_results(indices, vals):
+            for i, val in zip(indices, vals):
+                func, args, kwargs = self._calls[i]
+                func.set_result(func.get_cache_key(args, kwargs), val,
+                        generations[i])
+                results[i] = val
+            pending[0] -= 1
+
+        timeout = self._timeout
+        if timeout is None:
+            timeout = helper.TIMEOUT
+        start_time = time.time()
+        for conn, indices in byconn.iteritems():
+            calls = []
+            for i in indices:
+                func, args, kwargs = self._calls[i]
+                calls.append((func._objname, func._funcname, args, kwargs))
+            helper.call_many(conn, calls,
+                    callback=lambda vals, indices=indices: \
+                            store_results(indices, vals))
+
+        if not helper._wait(byconn.keys(), lambda: pending[0] == 0,
+                start_time + timeout):
+            logging.warning('Batch of %d calls timed out', len(self._calls))
+
+        self._calls = []
+        self._results = results
+        return results
+
+    def get_results(self):
+        return self._results
+
+def batch(timeout=None):
+    '''Return a Batch to group remote calls.'''
+    return Batch(timeout)
+
+def cache_result(f=None, invalidate=()):
+    '''
+    Decorator to cache the return value of a shared function in remote
+    proxies, per set of arguments. The cache is cleared when the object
+    emits one of the signals in <invalidate>:
+
+        @cache_result(invalidate=('parameter-added', 'parameter-removed'))
+        def get_parameter_names(self):
+            ...
+
+    Without <invalidate> the result is cached for the life time of the
+    proxy.
+    '''
+
+    def decorate(f):
+        f._share_options = {
+            'cache_result': True,
+            'invalidate': tuple(invalidate),
+        }
+        return f
+
+    if f is None:
+        return decorate
+    return decorate(f)
 
 class RootObject(SharedObject):
 
@@ -796,6 +1954,24 @@ class RootObject(SharedObject):
     def receive_signal(self, objname, signame, *args, **kwargs):
         helper.receive_signal(objname, signame, *args, **kwargs)
 
+    def get_capabilities(self):
+        '''Return list of supported protocol features.'''
+        return list(CAPABILITIES)
+
+    def add_subscription(self, objname, signame):
+        '''Request signal <signame> of object <objname> for the caller.'''
+        helper.add_subscription(helper.get_caller(), objname, signame)
+
+    def remove_subscription(self, objname, signame):
+        helper.remove_subscription(helper.get_caller(), objname, signame)
+
+    def get_send_statistics(self):
+        return helper.get_send_statistics()
+
+    def attach_shm(self, path, size):
+        '''Map shared memory ring <path> to receive from the caller.'''
+        return helper.attach_shm(helper.get_caller(), path, size)
+
     def list_objects(self):
         return self._objects.keys()
 
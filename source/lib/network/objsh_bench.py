@@ -0,0 +1,319 @@
+# objsh_bench.py, benchmark of object_sharer transfers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Benchmark of object_sharer over localhost.
+
+A server with a 'bench' object is started in a subprocess; the client
+measures the round trip latency of small calls, the throughput of large
+transfers, the time to get many small values one by one and batched and
+the rate at which signals are delivered. The callback registry is timed
+with NHANDLERS handlers, without network. No main loop is used, so it
+runs without QTLab:
+
+    python source/lib/network/objsh_bench.py [-o results.json] [--no-shm]
+        [--compress]
+
+Use --no-shm to send everything over the socket instead of passing large
+packets through shared memory, --compress to compress large packets as
+for remote hosts (implies --no-shm).
+
+Results can be compared with lib/benchmark.py.
+'''
+
+import os
+import sys
+import socket
+import select
+import subprocess
+import random
+import numpy
+
+_srcdir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if _srcdir not in sys.path:
+    sys.path.insert(0, _srcdir)
+
+from lib import benchmark
+from lib.misc import exact_time
+from lib.network import object_sharer as objsh
+
+TRANSFER_SIZES = (1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024)
+NVALUES = 200
+NLATENCY = 2000
+NSIGNALS = 10000
+NHANDLERS = 10000
+
+class BenchObject(objsh.SharedObject):
+
+    def __init__(self):
+        objsh.SharedObject.__init__(self, 'bench')
+        self._strings = {}
+        self._arrays = {}
+
+    def get_string(self, n):
+        if n not in self._strings:
+            self._strings[n] = 'x' * n
+        return self._strings[n]
+
+    def get_value(self, i):
+        return float(i)
+
+    def emit_values(self, n, signame='new-value'):
+        for i in range(n):
+            self.emit(signame, i)
+
+    def get_array(self, n):
+        if n not in self._arrays:
+            self._arrays[n] = numpy.zeros(n / 8)
+        return self._arrays[n]
+
+def serve(port):
+    '''
+    Run the benchmark server on <port> until the client disconnects.
+    '''
+
+    BenchObject()
+    objsh.root.set_instance_name('bench_server')
+
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(('127.0.0.1', port))
+    srv.listen(1)
+    print 'ready'
+    sys.stdout.flush()
+
+    conn, addr = srv.accept()
+    conn.setblocking(0)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    objsh.helper.add_client(conn, None)
+
+    while True:
+        if objsh.helper._send_queue.get(conn):
+            wlist = [conn]
+        else:
+            wlist = []
+        rlist, wlist, xlist = select.select([conn], wlist, [], 1)
+        if len(rlist) > 0 and not objsh.helper.receive(conn):
+            break
+        if len(wlist) > 0:
+            objsh.helper._process_send_queue()
+
+def connect(port):
+    '''Connect to the benchmark server, return proxy of 'bench'.'''
+
+    if objsh.root.get_instance_name() == '':
+        objsh.root.set_instance_name('bench_client')
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    conn.connect(('127.0.0.1', port))
+    conn.setblocking(0)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client = objsh.helper.add_client(conn, None)
+    info = client.get_object_info('bench')
+    return objsh.ObjectProxy(conn, info)
+
+def run_latency(suite, bench):
+    '''Time individual small calls; report the median and percentiles.'''
+    for i in range(100):
+        bench.get_value(i)
+
+    times = []
+    for i in range(NLATENCY):
+        start = exact_time()
+        bench.get_value(i)
+        times.append(exact_time() - start)
+    times.sort()
+    suite.add_result('objsh.latency', times[len(times) / 2], NLATENCY,
+            p90_us=times[int(len(times) * 0.9)] * 1e6,
+            p99_us=times[int(len(times) * 0.99)] * 1e6)
+
+def run_throughput(suite, bench, repeat=3):
+    for n in TRANSFER_SIZES:
+        _run_transfer(suite, 'objsh.transfer(%dMB)' % (n / 1024 / 1024),
+                bench.get_string, n, repeat)
+    for n in TRANSFER_SIZES:
+        _run_transfer(suite, 'objsh.transfer_array(%dMB)' % (n / 1024 / 1024),
+                bench.get_array, n, repeat)
+
+def _run_transfer(suite, name, func, n, repeat):
+    best = None
+    for i in range(repeat):
+        start = exact_time()
+        ret = func(n, timeout=60)
+        dt = exact_time() - start
+        if ret is None or len(ret) * getattr(ret, 'itemsize', 1) != n:
+            suite.skip(name, 'transfer failed')
+            break
+        if best is None or dt < best:
+            best = dt
+    else:
+        suite.add_result(name, best, 1, MBps=n / best / 1e6)
+
+def run_batch(suite, bench, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = exact_time()
+        for j in range(NVALUES):
+            bench.get_value(j)
+        dt = exact_time() - start
+        if best is None or dt < best:
+            best = dt
+    suite.add_result('objsh.get_value(x%d)' % NVALUES, best / NVALUES, NVALUES)
+
+    calls = [('get_value', (j, )) for j in range(NVALUES)]
+    best = None
+    for i in range(repeat):
+        start = exact_time()
+        ret = bench.call_many(calls)
+        dt = exact_time() - start
+        if ret != [float(j) for j in range(NVALUES)]:
+            suite.skip('objsh.call_many(%d)' % NVALUES, 'batch failed')
+            return
+        if best is None or dt < best:
+            best = dt
+    suite.add_result('objsh.call_many(%d)' % NVALUES, best / NVALUES, NVALUES)
+
+def run_signals(suite, bench):
+    received = []
+    hid = bench.connect('new-value', lambda val: received.append(val))
+    start = exact_time()
+    bench.emit_values(NSIGNALS)
+    # Signals not subscribed to should not arrive
+    bench.emit_values(NSIGNALS, 'other-value')
+    objsh.helper._wait([bench.get_connection()],
+            lambda: len(received) == NSIGNALS, start + 10)
+    dt = exact_time() - start
+    bench.disconnect(hid)
+
+    name = 'objsh.signals(%d)' % NSIGNALS
+    if len(received) != NSIGNALS:
+        suite.skip(name, 'received %d signals' % len(received))
+    else:
+        suite.add_result(name, dt / NSIGNALS, NSIGNALS)
+
+def run_registry(suite, n=NHANDLERS):
+    '''
+    Time connect, dispatch and disconnect of <n> handlers in the callback
+    registry of a local ObjectSharer.
+    '''
+
+    sharer = objsh.ObjectSharer()
+    calls = [0]
+    def callback(*args, **kwargs):
+        calls[0] += 1
+
+    start = exact_time()
+    hids = [sharer.connect('obj', 'many', callback) for i in xrange(n)]
+    for i in xrange(n):
+        sharer.connect('obj%d' % i, 'one', callback, i)
+    dt = exact_time() - start
+    suite.add_result('objsh.registry.connect(%d)' % (2 * n), dt / (2 * n),
+            2 * n)
+
+    start = exact_time()
+    sharer.receive_signal('obj', 'many', None, 1.0)
+    dt = exact_time() - start
+    suite.add_result('objsh.registry.dispatch(%d handlers)' % n, dt / n, n)
+
+    suite.run('objsh.registry.dispatch(1 handler)',
+            lambda: sharer.receive_signal('obj1', 'one', None, 1.0))
+
+    random.seed(0)
+    random.shuffle(hids)
+    start = exact_time()
+    for hid in hids:
+        sharer.disconnect(hid)
+    dt = exact_time() - start
+    suite.add_result('objsh.registry.disconnect(%d)' % n, dt / n, n)
+
+def run(port=None, outfile=None, suite=None):
+    '''
+    Run the benchmark against a server started in a subprocess.
+
+    Input:
+        port (int): TCP port to use, default objsh.PORT + 100
+        outfile (string): write results to this JSON file
+        suite (BenchmarkSuite): add results to this suite instead of a new
+            one, e.g. to include them in a larger benchmark
+
+    Output: dictionary of results
+    '''
+
+    if port is None:
+        port = objsh.PORT + 100
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--server', str(port)]
+    if not objsh.USE_SHM:
+        cmd.append('--no-shm')
+    if objsh.COMPRESS_LOCAL:
+        cmd.append('--compress')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    proc.stdout.readline()
+
+    if suite is None:
+        suite = benchmark.BenchmarkSuite('object_sharer')
+    conn = None
+    try:
+        bench = connect(port)
+        conn = bench.get_connection()
+        run_latency(suite, bench)
+        run_throughput(suite, bench)
+        run_batch(suite, bench)
+        run_signals(suite, bench)
+        run_registry(suite)
+        # Statistics of the server, it compresses the replies
+        for client in objsh.helper.get_clients():
+            if client.get_connection() != conn:
+                continue
+            for name, stats in client.get_send_statistics().items():
+                if stats['compressed'] > 0:
+                    print 'Compression saved %d bytes in %.03fs' % \
+                            (stats['compress_saved'], stats['compress_time'])
+        if outfile is not None:
+            suite.save(outfile)
+    finally:
+        # Only close our own connection, we might be running inside QTLab
+        if conn is not None:
+            conn.close()
+            objsh.helper._client_disconnected(conn)
+        else:
+            proc.kill()
+        proc.wait()
+
+    return suite.get_results()
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(description='object_sharer benchmark')
+    parser.add_option('-p', '--port', type=int, default=None,
+        help='TCP port to use')
+    parser.add_option('-o', '--output', default=None,
+        help='Write results to JSON file')
+    parser.add_option('--no-shm', action='store_true', default=False,
+        help='Do not use shared memory')
+    parser.add_option('--compress', action='store_true', default=False,
+        help='Compress large packets')
+    parser.add_option('--server', type=int, default=None,
+        help=optparse.SUPPRESS_HELP)
+    args, pargs = parser.parse_args()
+    if args.no_shm or args.compress:
+        objsh.USE_SHM = False
+    if args.compress:
+        objsh.COMPRESS_LOCAL = True
+
+    if args.server is not None:
+        serve(args.server)
+    else:
+        run(args.port, args.output)
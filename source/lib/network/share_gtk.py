@@ -10,8 +10,20 @@ class Handler(tcpservergtk.GlibTCPHandler):
     def __init__(self, sock, client_address, server):
         tcpservergtk.GlibTCPHandler.__init__(self, sock, client_address, server,
                 packet_len=True)
+        # Calls are small request/reply packets, don't delay them
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error, e:
+            logging.debug('Unable to set TCP_NODELAY: %s', e)
         self.client = objsh.helper.add_client(self.socket, self)
 
+    def _handle_recv(self, sock, condition):
+        # Receive straight into the object sharer's buffer
+        if not objsh.helper.receive(self.socket):
+            self._handle_hup()
+            return False
+        return True
+
     def handle(self, data):
         if len(data) > 0:
             data = objsh.helper.handle_data(self.socket, data)
@@ -19,11 +31,20 @@ class Handler(tcpservergtk.GlibTCPHandler):
 
 _flush_queue_hid = None
 
+def _send_ready_cb(sock, condition):
+    objsh.helper._process_send_queue(sock)
+    return objsh.helper.is_behind(sock)
+
+def _send_blocked_cb(sock):
+    # Continue sending as soon as the socket is writable
+    gobject.io_add_watch(sock, gobject.IO_OUT, _send_ready_cb)
+
 def setup_glib_flush_queue():
     global _flush_queue_hid
     if _flush_queue_hid is not None:
         return
     _flush_queue_hid = gobject.timeout_add(2000, objsh.helper._process_send_queue)
+    objsh.helper.register_event_callback('send-blocked', _send_blocked_cb)
 
 def start_server(host='', port=objsh.PORT):
     try:
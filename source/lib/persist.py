@@ -0,0 +1,176 @@
+# persist.py, write-behind store for persistent instrument parameters
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gobject
+import os
+import logging
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.config import get_config
+
+class PersistStore:
+    '''
+    Store for the values of FLAG_PERSIST instrument parameters.
+
+    Values are kept in memory and written to one small file per instrument
+    (<persistdir>/<instrument>.json). Writing is delayed so that a sweep of
+    a persistent parameter results in a single write instead of one per set.
+    Files are written to a temporary file first and then renamed, so a crash
+    while saving does not leave a truncated file behind.
+    '''
+
+    def __init__(self, dirname=None, delay=5):
+        '''
+        Input:
+            dirname (string): directory to store files in. If None, use
+                config['persistdir'] or <execdir>/persist.
+            delay (float): delay in seconds between a change and the write.
+        '''
+
+        self._dirname = dirname
+        self._delay = delay
+        self._values = {}
+        self._dirty = set()
+        self._save_hid = None
+
+    def get_dirname(self):
+        if self._dirname is None:
+            config = get_config()
+            dirname = config.get('persistdir', None)
+            if dirname is None:
+                dirname = os.path.join(config['execdir'], 'persist')
+            self._dirname = dirname
+        return self._dirname
+
+    def _get_filename(self, insname):
+        return os.path.join(self.get_dirname(), '%s.json' % insname)
+
+    def _load(self, insname):
+        '''
+        Load all stored values for instrument <insname> in one go.
+        '''
+
+        if insname in self._values:
+            return self._values[insname]
+
+        values = {}
+        filename = self._get_filename(insname)
+        if os.path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                values = json.load(f)
+                f.close()
+            except Exception, e:
+                logging.warning('Unable to load persist file %s: %s',
+                        filename, str(e))
+                values = {}
+
+        self._values[insname] = values
+        return values
+
+    def get(self, insname, param, default=None):
+        '''
+        Return stored value of parameter <param> of instrument <insname>.
+
+        Values stored in the main config file by older versions
+        (persist_<ins>_<param>) are used as fall-back.
+        '''
+
+        values = self._load(insname)
+        if param in values:
+            return values[param]
+
+        key = 'persist_%s_%s' % (insname, param)
+        val = get_config().get(key)
+        if val is not None:
+            values[param] = val
+            self._set_dirty(insname)
+            return val
+
+        return default
+
+    def set(self, insname, param, val):
+        '''
+        Remember value <val> for parameter <param> of instrument <insname>.
+        The value is written to disk after a delay, or on flush().
+        '''
+
+        values = self._load(insname)
+        if param in values and values[param] == val:
+            return
+        values[param] = val
+        self._set_dirty(insname)
+
+    def _set_dirty(self, insname):
+        self._dirty.add(insname)
+        if self._save_hid is None:
+            self._save_hid = gobject.timeout_add(int(self._delay * 1000),
+                    self._save_timeout_cb)
+
+    def _save_timeout_cb(self):
+        self._save_hid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        '''
+        Write all changed values to disk now.
+        '''
+
+        if self._save_hid is not None:
+            gobject.source_remove(self._save_hid)
+            self._save_hid = None
+
+        dirty = self._dirty
+        self._dirty = set()
+        for insname in dirty:
+            self._save(insname)
+
+    def _save(self, insname):
+        dirname = self.get_dirname()
+        filename = self._get_filename(insname)
+        tmpname = filename + '.tmp'
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+            f = open(tmpname, 'w')
+            json.dump(self._values[insname], f, sort_keys=True)
+            f.close()
+
+            # os.rename does not replace existing files on windows
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except Exception, e:
+            logging.warning('Unable to save persist file %s: %s',
+                    filename, str(e))
+            # Try again later
+            self._set_dirty(insname)
+
+_store = None
+
+def get_persist_store():
+    '''Get the global persist store.'''
+    global _store
+    if _store is None:
+        _store = PersistStore()
+    return _store
@@ -17,9 +17,12 @@
 
 import gobject
 import types
+import random
+import logging
 
 from qtflow import get_flowcontrol
 from lib.misc import exact_time
+from lib import busarbiter
 
 class Scheduler():
     '''
@@ -224,4 +227,208 @@ class Scheduler():
         self.stop()
         self.start()
 
+class ProbeScheduler():
+    '''
+    Central scheduler for the periodic 'probe_interval' gets of instrument
+    parameters.
+
+    A single timer is used for all probes. Probes that are due at the same
+    time on one instrument are combined in a single get. While a
+    measurement is running probes can be paused or throttled, so that they
+    do not compete with the measurement for the instrument bus.
+    '''
+
+    MEASURING_RUN = 'run'
+    MEASURING_THROTTLE = 'throttle'
+    MEASURING_PAUSE = 'pause'
+
+    def __init__(self, jitter=0.1, measuring_policy='pause',
+                 throttle_factor=10):
+        '''
+        Input:
+            jitter (float): random fraction of the interval added to or
+                subtracted from each deadline, to spread out probes.
+            measuring_policy (string): 'run', 'throttle' or 'pause'
+            throttle_factor (float): interval multiplier when throttling
+        '''
+
+        self._flow = get_flowcontrol()
+        self._jitter = jitter
+        self._measuring_policy = measuring_policy
+        self._throttle_factor = throttle_factor
 
+        self._probes = {}
+        self._timer_hid = None
+        self._timer_deadline = None
+
+    def add_probe(self, ins, name, interval):
+        '''
+        Probe parameter <name> of instrument <ins> every <interval> ms.
+        '''
+
+        interval = interval / 1000.0
+        self._probes[(ins, name)] = {
+            'interval': interval,
+            'deadline': exact_time() + self._jittered(interval),
+            'count': 0,
+            'missed': 0,
+            'deferred': 0,
+            'total_late': 0.0,
+            'max_late': 0.0,
+        }
+        self._schedule()
+
+    def remove_probe(self, ins, name):
+        '''Stop probing parameter <name> of instrument <ins>.'''
+        if (ins, name) in self._probes:
+            del self._probes[(ins, name)]
+
+    def remove_instrument(self, ins):
+        '''Stop probing all parameters of instrument <ins>.'''
+        for key in self._probes.keys():
+            if key[0] is ins:
+                del self._probes[key]
+
+    def set_jitter(self, jitter):
+        self._jitter = jitter
+
+    def get_jitter(self):
+        return self._jitter
+
+    def set_measuring_policy(self, policy):
+        '''
+        Set what to do with probes while a measurement is running:
+            'run': probe as usual
+            'throttle': probe at a lower rate (see set_throttle_factor)
+            'pause': do not probe at all
+        '''
+
+        if policy not in (self.MEASURING_RUN, self.MEASURING_THROTTLE,
+                self.MEASURING_PAUSE):
+            logging.warning('Invalid probe policy %r', policy)
+            return
+        self._measuring_policy = policy
+
+    def get_measuring_policy(self):
+        return self._measuring_policy
+
+    def set_throttle_factor(self, factor):
+        self._throttle_factor = factor
+
+    def get_throttle_factor(self):
+        return self._throttle_factor
+
+    def get_statistics(self):
+        '''
+        Return a dictionary '<instrument>.<parameter>' -> statistics dict
+        with keys:
+            interval: probe interval in seconds
+            count: number of probes performed
+            missed: number of deadlines that passed without a probe
+            deferred: number of probes postponed because of a measurement
+            mean_late, max_late: lateness of probes in seconds
+        '''
+
+        ret = {}
+        for (ins, name), p in self._probes.iteritems():
+            if p['count'] > 0:
+                mean_late = p['total_late'] / p['count']
+            else:
+                mean_late = 0.0
+            ret['%s.%s' % (ins.get_name(), name)] = {
+                'interval': p['interval'],
+                'count': p['count'],
+                'missed': p['missed'],
+                'deferred': p['deferred'],
+                'mean_late': mean_late,
+                'max_late': p['max_late'],
+            }
+        return ret
+
+    def reset_statistics(self):
+        for p in self._probes.values():
+            p['count'] = 0
+            p['missed'] = 0
+            p['deferred'] = 0
+            p['total_late'] = 0.0
+            p['max_late'] = 0.0
+
+    def _jittered(self, interval):
+        return interval * (1 + self._jitter * random.uniform(-1, 1))
+
+    def _get_interval(self, p):
+        if self._flow.is_measuring() and \
+                self._measuring_policy == self.MEASURING_THROTTLE:
+            return p['interval'] * self._throttle_factor
+        return p['interval']
+
+    def _schedule(self):
+        if len(self._probes) == 0:
+            return
+
+        deadline = min([p['deadline'] for p in self._probes.values()])
+        if self._timer_hid is not None:
+            if deadline >= self._timer_deadline:
+                return
+            gobject.source_remove(self._timer_hid)
+
+        delay = max(0, int((deadline - exact_time()) * 1000))
+        self._timer_deadline = deadline
+        self._timer_hid = gobject.timeout_add(delay, self._timeout_cb)
+
+    def _timeout_cb(self):
+        self._timer_hid = None
+        self._timer_deadline = None
+
+        now = exact_time()
+        pause = self._flow.is_measuring() and \
+                self._measuring_policy == self.MEASURING_PAUSE
+
+        due = {}
+        for (ins, name), p in self._probes.iteritems():
+            if p['deadline'] > now:
+                continue
+
+            interval = self._get_interval(p)
+            if pause:
+                p['deferred'] += 1
+                p['deadline'] = now + self._jittered(interval)
+                continue
+
+            late = now - p['deadline']
+            p['count'] += 1
+            p['total_late'] += late
+            p['max_late'] = max(p['max_late'], late)
+
+            # Keep the original rate unless we are more than an interval late
+            nmissed = int(late / interval)
+            if nmissed > 0:
+                p['missed'] += nmissed
+                p['deadline'] = now + self._jittered(interval)
+            else:
+                p['deadline'] += self._jittered(interval)
+
+            if ins in due:
+                due[ins].append(name)
+            else:
+                due[ins] = [name]
+
+        for ins, names in due.iteritems():
+            try:
+                busarbiter.call_with_priority(busarbiter.PRIORITY_BACKGROUND,
+                        ins.get, names)
+            except Exception, e:
+                logging.warning('Probing %s of %s failed: %s',
+                        names, ins.get_name(), str(e))
+
+        self._schedule()
+        return False
+
+_probe_scheduler = None
+
+def get_probe_scheduler():
+    '''Get the global probe scheduler.'''
+    global _probe_scheduler
+    if _probe_scheduler is None:
+        _probe_scheduler = ProbeScheduler()
+    return _probe_scheduler
@@ -18,6 +18,7 @@
 import time
 import logging
 import warnings
+from lib.misc import exact_time
 
 try:
     from visa import *
@@ -31,17 +32,106 @@ def get_navail(visains):
     '''
     return vpp43.get_attribute(visains, vpp43.VI_ATTR_ASRL_AVAIL_NUM)
 
+# Sessions on which serial character events are enabled (True) or not
+# supported (False)
+_char_events = {}
+
+def _enable_char_events(visains):
+    if visains not in _char_events:
+        try:
+            vpp43.enable_event(visains, vpp43.VI_EVENT_ASRL_CHAR,
+                    vpp43.VI_QUEUE)
+            _char_events[visains] = True
+        except Exception, e:
+            logging.warning('Serial character events not available, '
+                    'polling instead: %s', str(e))
+            _char_events[visains] = False
+    return _char_events[visains]
+
+def _wait_char(visains, timeout):
+    '''
+    Block until a character arrives on visains or <timeout> seconds have
+    passed. Return True if a character arrived.
+    '''
+
+    try:
+        evtype, context = vpp43.wait_on_event(visains,
+                vpp43.VI_EVENT_ASRL_CHAR, max(int(timeout * 1000), 1))
+    except Exception, e:
+        if getattr(e, 'error_code', None) != vpp43.VI_ERROR_TMO:
+            logging.warning('Waiting for serial event failed: %s', str(e))
+            _char_events[visains] = False
+        return False
+
+    vpp43.close(context)
+    return True
+
 def wait_data(visains, nbytes=1, maxdelay=1.0):
     '''
     Wait for maxdelay seconds for data available to read from visains.
-    The loop consist of 1msec delays.
+    Blocks on VISA serial character events, so it returns as soon as the
+    data arrives; falls back to polling every msec if events are not
+    supported.
     '''
+
     start = exact_time()
+    if _enable_char_events(visains):
+        vpp43.discard_events(visains, vpp43.VI_EVENT_ASRL_CHAR,
+                vpp43.VI_QUEUE)
+        while True:
+            if get_navail(visains) >= nbytes:
+                return True
+            remaining = maxdelay - (exact_time() - start)
+            if remaining <= 0 or not _char_events[visains]:
+                break
+            _wait_char(visains, remaining)
+
     while exact_time() - start < maxdelay:
         if get_navail(visains) >= nbytes:
             return True
         time.sleep(0.001)
-    return False
+    return get_navail(visains) >= nbytes
+
+# Expected reply lengths: (session, command) -> number of bytes
+_reply_lengths = {}
+
+def register_reply_length(visains, cmd, nbytes):
+    '''
+    Register that command <cmd> sent to visains is answered with <nbytes>
+    bytes, so that read_reply() can return as soon as they have arrived.
+    '''
+    _reply_lengths[(visains, cmd)] = nbytes
+
+def get_reply_length(visains, cmd):
+    return _reply_lengths.get((visains, cmd), None)
+
+def read_reply(visains, cmd=None, nbytes=None, timeout=1.0, gap=0.02):
+    '''
+    Read the reply to a command from visains.
+
+    If the length is known (<nbytes>, or registered for <cmd>) the reply
+    is returned as soon as that many bytes have arrived. Otherwise the
+    reply ends when no data arrives for <gap> seconds.
+
+    Returns '' if nothing arrives within <timeout> seconds.
+    '''
+
+    if nbytes is None and cmd is not None:
+        nbytes = get_reply_length(visains, cmd)
+
+    if nbytes is not None:
+        if wait_data(visains, nbytes, timeout):
+            return readn(visains, nbytes)
+        logging.warning('Expected %d bytes, received %d', nbytes,
+                get_navail(visains))
+        return read_all(visains)
+
+    if not wait_data(visains, 1, timeout):
+        return ''
+    buf = read_all(visains)
+    while wait_data(visains, 1, gap):
+        buf += read_all(visains)
+    return buf
 
 def readn(visains, n):
     return vpp43.read(visains, n)
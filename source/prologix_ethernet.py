@@ -15,11 +15,15 @@ released under the GPL, whatever version
 Changelog:
 0.1 March 2010, initial version, very alpha, most of the functionality is far from bullet proof.
 2010-2013: incorporated into qtlab main, Reinier Heeres
+2014: one shared controller connection per adapter
 """
 
 import socket
+import threading
 import time
 import re
+import logging
+import visa
 
 ip = None
 port = None
@@ -28,11 +32,155 @@ def set_controller_address(addr, nport):
     ip = addr
     port = nport
 
-# Connection information to share controller between different instruments
-class ConnectionInfo:
-    def __init__(self, sock, gpib_address=None):
-        self.sock = sock
-        self.gpib_address = gpib_address
+class Controller:
+    """
+    Connection to one prologix adapter, shared by all instruments on it.
+
+    The controller remembers the GPIB address and the '++' settings that
+    were last sent, so that they are only sent again when they change.
+    Use the lock to group the commands of a single transaction.
+    """
+
+    # End-of-transmission character appended by the adapter when the
+    # device asserts EOI; used to find the end of a reply.
+    EOT_CHAR = '\x04'
+
+    def __init__(self, addr, nport, timeout=5):
+        self.lock = threading.RLock()
+        self._addr = addr
+        self._port = nport
+        self._timeout = timeout
+        self._gpib_address = None
+        self._settings = {}
+        self._buffer = ''
+        self._stale = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                socket.IPPROTO_TCP)
+        self.sock.settimeout(timeout)
+        self.sock.connect((addr, nport))
+
+        self.set_option('savecfg', 0)
+        self.set_option('mode', 1)
+        self.set_option('auto', 0)
+        self.set_option('eot_enable', 1)
+        self.set_option('eot_char', ord(self.EOT_CHAR))
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def set_option(self, name, val):
+        """Send '++<name> <val>', unless that was the last value sent."""
+        val = str(val)
+        if self._settings.get(name, None) == val:
+            return
+        self.send('++%s %s\n' % (name, val))
+        self._settings[name] = val
+
+    def invalidate(self):
+        """Forget adapter state, e.g. after a reset."""
+        self._gpib_address = None
+        self._settings = {}
+
+    def select(self, gpib_address):
+        """Address device <gpib_address>, if not addressed already."""
+        if self._gpib_address == gpib_address:
+            return
+        self.send('++addr %d\n' % gpib_address)
+        self._gpib_address = gpib_address
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if len(data) == 0:
+            raise socket.error('Prologix adapter closed the connection')
+        self._buffer += data
+
+    def _drain(self):
+        """Drop data that arrived late, after a read timed out."""
+        self.sock.settimeout(0)
+        try:
+            try:
+                while len(self.sock.recv(65536)) > 0:
+                    pass
+            except socket.error:
+                pass
+        finally:
+            self.sock.settimeout(self._timeout)
+        self._buffer = ''
+        self._stale = False
+
+    def read(self, nbytes=None, block=False):
+        """
+        Request data from the addressed device and return the reply.
+
+        The reply ends where the adapter inserted the EOT character. If
+        <nbytes> is given, exactly that many bytes are returned before
+        looking for the EOT, so binary data can contain the EOT character.
+        With <block> set, the length is taken from the header of a binary
+        block reply (see visa.parse_block_header).
+
+        socket.timeout is raised if the reply does not arrive in time; the
+        rest of that reply is dropped before the next read.
+        """
+
+        if self._stale:
+            self._drain()
+        self.send('++read eoi\n')
+        try:
+            if block:
+                while len(self._buffer) == 0:
+                    self._recv()
+                if self._buffer[0] == '#':
+                    while True:
+                        hdr = visa.parse_block_header(self._buffer)
+                        if hdr is not None:
+                            break
+                        self._recv()
+                    if hdr[1] is not None:
+                        nbytes = hdr[0] + hdr[1]
+
+            if nbytes is not None:
+                while len(self._buffer) < nbytes:
+                    self._recv()
+                ret = self._buffer[:nbytes]
+                self._buffer = self._buffer[nbytes:]
+            else:
+                ret = ''
+
+            while True:
+                idx = self._buffer.find(self.EOT_CHAR)
+                if idx >= 0:
+                    break
+                self._recv()
+        except socket.timeout:
+            logging.warning('Prologix read timed out')
+            self._buffer = ''
+            self._stale = True
+            raise
+
+        ret += self._buffer[:idx]
+        self._buffer = self._buffer[idx+1:]
+        return ret
+
+    def flush(self):
+        """Drop data that was not read."""
+        self._buffer = ''
+
+CONTROLLERS = {}
+
+def get_controller(addr=None, nport=None):
+    """Return the shared controller for an adapter, connect if needed."""
+    if addr is None:
+        addr = ip
+    if nport is None:
+        nport = port
+    connid = (addr, nport)
+    if connid not in CONTROLLERS:
+        CONTROLLERS[connid] = Controller(addr, nport)
+    return CONTROLLERS[connid]
 
 class instrument(object):
     """
@@ -45,11 +193,7 @@ class instrument(object):
         visa='prologix_ethernet')
     """
 
-    CONNECTIONS = {}
-
-    def __init__(self, gpib, **kwargs):	
-        self.conn = None
-
+    def __init__(self, gpib, **kwargs):
         # for compatibility with NI visa
         self.timeout = kwargs.get("timeout", 5)
         self.chunk_size = kwargs.get("chunk_size", 20*1024)
@@ -67,37 +211,24 @@ class instrument(object):
 
         if self.send_end:
             self.term_char = '\r\n'
-            self._set_EOI_assert()
-
-        # disable the automatic saving of parameters in
-        # the ethernet-gpib device,
-
-        self._set_saveconfig(False)
-
-        # set set the ethernet gpib device to be the controller of#
-        # the gpib chain
-        self._set_controller_mode()
-        # set the GPIB address of the device
-        self._set_gpib_address()
-
-        self._set_EOI_assert()
-        self._set_read_timeout()
-        self._set_read_after_write(False)
-        #self._dump_internal_vars()
+        elif self.term_char is None:
+            self.term_char = '\n'
 
     # wrapper functions for py visa
     def write(self, cmd):
         return self._send(cmd)
     def read(self):
         return self._recv()
-    def read_values(self, format):
-        return self._recv()
+    def read_raw(self):
+        return self._recv(block=True)
+    def read_values(self, format=None):
+        return self._parse_values(self._recv())
 
     def ask(self, cmd):
         return self._send_recv(cmd)
 
     def ask_for_values(self, cmd, format=None):
-        return self._send_recv(cmd)
+        return self._parse_values(self._send_recv(cmd))
 
     def clear(self):
         return self._set_reset()
@@ -117,117 +248,118 @@ class instrument(object):
             return int(m.group(2))
         else:
             raise self.Error("Only GPIB:: is supported!")
+
+    def _parse_values(self, data):
+        return [float(v) for v in data.strip().split(',') if v != '']
+
     #
     # internal commands to access the prologix gpib device
     #
 
+    def _prepare(self):
+        # Called with the controller lock held
+        ctrl = self.conn
+        ctrl.select(self.gpib_addr)
+        ctrl.set_option('eoi', int(self.send_end))
+        ctrl.set_option('read_tmo_ms', int(min(self.timeout, 3) * 1000))
+
     def _send(self, cmd):
         cmd = cmd.rstrip()
         cmd += self.term_char
-        #self._set_read_after_write(False)
-        self.conn.sock.send(cmd)
-        time.sleep(self.delay)
+        self.conn.lock.acquire()
+        try:
+            self._prepare()
+            self.conn.send(cmd)
+        finally:
+            self.conn.lock.release()
+        if self.delay:
+            time.sleep(self.delay)
 
     def _send_recv(self, cmd, **kwargs):
-        bufflen = kwargs.get("bufflen", self.chunk_size)
-        cmd = cmd.rstrip()
-        cmd += self.term_char
-        #print cmd
-
-        self._send(cmd)
-        self._set_read()
-        return self.conn.sock.recv(bufflen)
+        self.conn.lock.acquire()
+        try:
+            self._send(cmd)
+            return self._recv(**kwargs)
+        finally:
+            self.conn.lock.release()
 
     def _recv(self, **kwargs):
-        bufflen = kwargs.get("bufflen", self.chunk_size)
-        self._set_read()
-
-        buff = self.conn.sock.recv(bufflen)
-        return buff
+        nbytes = kwargs.get("nbytes", None)
+        block = kwargs.get("block", False)
+        self.conn.lock.acquire()
+        try:
+            self._prepare()
+            return self.conn.read(nbytes, block)
+        finally:
+            self.conn.lock.release()
 
     def _open_connection(self):
-        connid = (ip, port)
-        if connid in instrument.CONNECTIONS:
-            self.conn = instrument.CONNECTIONS[connid]
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
-                socket.IPPROTO_TCP)
-        sock.settimeout(0.1)
-        sock.connect((ip, port))
-        self.conn = ConnectionInfo(sock, None)
-        instrument.CONNECTIONS[connid] = self.conn
+        self.conn = get_controller()
+        self.sock = self.conn.sock
 
     def _close_connection(self):
-        self.sock.close()
+        for connid, ctrl in CONTROLLERS.items():
+            if ctrl is self.conn:
+                del CONTROLLERS[connid]
+        self.conn.close()
 
     def _set_read(self):
         self._send("++read eoi")
 
     def _set_saveconfig(self, On=False):
         # should not be used very frequently
-        if On:
-            self._send("++savecfg 1")
-        else:
-            self._send("++savecfg 0")
+        self.conn.set_option('savecfg', int(On))
 
     def _set_gpib_address(self, **kwargs):
         # GET GPIB address
         self.gpib_addr = kwargs.get("gpib_addr", self.gpib_addr)
-        # SET GPIB address on the device
-        self._send("++addr " + str(self.gpib_addr) + "\n")
+        self.conn.lock.acquire()
+        self.conn.select(self.gpib_addr)
+        self.conn.lock.release()
 
     def _set_controller_mode(self, C_Mode=True):
         # set gpib_ethernet into controller mode (True) or in device mode (False)
-        if C_Mode:
-            # controller mode
-            self._send("++mode 1")
-        else:
-            # device mode
-            self._send("++mode 0")
+        self.conn.set_option('mode', int(C_Mode))
 
     def _set_read_after_write(self, On=True):
-        if On:
-            # Turn on read-after-write
-            self.sock.send("++auto 1\r\n")
-        else:
-            # Turn off read-after-write to avoid "Query Unterminated" errors
-            self.sock.send("++auto 0\r\n")
+        # Read-after-write off avoids "Query Unterminated" errors
+        self.conn.set_option('auto', int(On))
 
     def _set_read_timeout(self, **kwargs):
-        timeout = kwargs.get("timeout", self.timeout)
-        # Read timeout is maximal 3 seconds for my device
-        if timeout > 3:
-                timeout = 3
-        self._send("++read_tmo_ms "+str(timeout*1000))
+        self.timeout = kwargs.get("timeout", self.timeout)
 
     def _set_EOI_assert(self, On=True): #
         # Assert EOI signal line with last byte to indicate end of data
-        if On:
-            self._send("++eoi 1\n")
-        else:
-            self._send("++eoi 0\n")
+        self.send_end = On
 
     def _set_GPIB_EOS(self, EOS='\n'): # end of signal/string
         EOSs={'\r\n':0, '\r':1, '\n':2, '':3}
-        self.sock.send("++eos"+EOSs.get(EOS)+"\n")
+        self.conn.set_option('eos', EOSs.get(EOS))
 
-    def _set_GPIB_EOT(self, EOT=False):
-        # send at EOI an EOT (end of transmission) character ?
-        if EOT:
-            self.sock.send("++eot_enable 1\n")
-        else:
-            self.sock.send("++eot_enable 0\n")
-
-    def _set_GPIB_EOT_char(self, EOT_char=42):
-        # set the EOT character
-        self.sock.send("++eot_char" + EOT_char + "\n")
+    def _set_trigger(self):
+        self.conn.lock.acquire()
+        try:
+            self._prepare()
+            self.conn.send('++trg\n')
+        finally:
+            self.conn.lock.release()
 
     def _set_ifc(self):
-        self._send("++ifc")
+        self.conn.lock.acquire()
+        try:
+            self.conn.send('++ifc\n')
+        finally:
+            self.conn.lock.release()
 
     def _set_reset(self):
         # Reset Device GPIB endpoint
-        self._send("++rst")
+        self.conn.lock.acquire()
+        try:
+            self.conn.send('++rst\n')
+            self.conn.invalidate()
+            self.conn.flush()
+        finally:
+            self.conn.lock.release()
 
     def _set_GPIB_dev_reset(self):
         # Reset Device GPIB endpoint
@@ -237,16 +369,16 @@ class instrument(object):
         return self._send_recv("*IDN?")
 
     def _dump_internal_vars(self):
-        print "timeout" + self.timeout
-        print "chunk_size" + self.chunk_size
-        print "values_format" + self.values_format
-        print "term_char" + self.term_char
-        print "send_end" + self.send_end
-        print "delay" + self.delay
-        print "lock" + self.lock
-        print "gpib_addr" + self.gpib_addr
-        print "ip" + ip
-        print "port" + port
+        print "timeout", self.timeout
+        print "chunk_size", self.chunk_size
+        print "values_format", self.values_format
+        print "term_char", repr(self.term_char)
+        print "send_end", self.send_end
+        print "delay", self.delay
+        print "lock", self.lock
+        print "gpib_addr", self.gpib_addr
+        print "ip", ip
+        print "port", port
 
     # generic error class
     class Error(Exception):
@@ -257,27 +389,18 @@ class instrument(object):
 
     def CheckError(self):
         # check for device error
-        self.sock.send("SYST:ERR?\n")
-        self.sock.send("++read eoi\n")
-
-        s = None
-
         try:
-            s = self.sock.recv(100)
-        except socket.timeout:
-            print "socket timeout"
-            s = ""
-
+            s = self._send_recv("SYST:ERR?")
         except socket.error, e:
-            pass
+            print "socket error: %s" % e
+            s = ""
 
         print s
-        print e
 
 # do some checking ...
 if __name__ == "__main__":
-   ls = instrument("GPIB::10", ip="172.22.197.181", delay=0.01)
+   set_controller_address("172.22.197.181", 1234)
+   ls = instrument("GPIB::10", delay=0.01)
    ls.write("*IDN?")
    print ls.read()
    ls._close_connection()
-
@@ -16,8 +16,13 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
+import re
 import socket
 import select
+import struct
+import time
+import numpy
+import visa_trace
 
 try:
     from pyvisa import SerialInstrument
@@ -26,7 +31,9 @@ except:
 
 _drivers = (
     'pyvisa',
-    'prologix_ethernet'
+    'prologix_ethernet',
+    'sim',
+    'replay',
 )
 
 def set_visa(name):
@@ -36,27 +43,211 @@ def set_visa(name):
     try:
         if name == "pyvisa":
             from pyvisa import visa as module
+        elif name == "sim":
+            import visa_sim as module
+        elif name == "replay":
+            module = visa_trace
         else:
             module = __import__(name)
         global instrument
         instrument = module.instrument
+        if visa_trace.is_recording() and name != "replay":
+            instrument = visa_trace.recording_factory(instrument)
     except:
         logging.warning('Unable to load visa driver %s', name)
 
+# Definite length binary block inside a command
+_BLOCK_RE = re.compile('#[1-9]')
+
+def parse_block_header(data, offset=0):
+    '''
+    Parse the header of a binary block starting at data[offset].
+
+    Supported are IEEE 488.2 blocks ('#<n><length>', or '#0' for
+    indefinite length) and HP blocks ('#A' and a 16 bit length).
+
+    Output: (start, length) of the payload, length is None for '#0'.
+        None if <data> does not contain the complete header yet.
+    '''
+
+    if len(data) < offset + 2:
+        return None
+    if data[offset:offset+1] != '#':
+        raise ValueError('Data is not a binary block')
+
+    c = str(data[offset+1:offset+2])
+    if c == 'A':
+        if len(data) < offset + 4:
+            return None
+        length, = struct.unpack('>H', str(data[offset+2:offset+4]))
+        return offset + 4, length
+    if not c.isdigit():
+        raise ValueError('Invalid binary block header %r' % c)
+
+    n = int(c)
+    if n == 0:
+        return offset + 2, None
+    if len(data) < offset + 2 + n:
+        return None
+    return offset + 2 + n, int(str(data[offset+2:offset+2+n]))
+
+def parse_block(data, dtype='B', offset=0):
+    '''
+    Return the payload of the binary block at data[offset] as a numpy
+    array with type <dtype>; e.g. '>f4' for big endian floats. The array
+    refers to the memory of <data>, no copy is made.
+
+    Output: (array, offset of the first byte after the block)
+    '''
+
+    hdr = parse_block_header(data, offset)
+    if hdr is None:
+        raise ValueError('Incomplete binary block header')
+    start, length = hdr
+    if length is None:
+        length = len(data) - start
+        if data[-1:] == '\n':
+            length -= 1
+    if start + length > len(data):
+        raise ValueError('Binary block truncated: expected %d bytes, got %d' \
+                % (length, len(data) - start))
+
+    dtype = numpy.dtype(dtype)
+    count = length // dtype.itemsize
+    arr = numpy.frombuffer(data, dtype=dtype, count=count, offset=start)
+    return arr, start + length
+
+def read_block(ins, cmd=None, dtype='B'):
+    '''
+    Read a binary block reply from visa style instrument <ins> and return
+    the payload as a numpy array of type <dtype>. If <cmd> is given it is
+    written first.
+
+    The raw reply is read with ins.read_raw() if available, so that it is
+    not cut at termination characters inside the data.
+    '''
+
+    if cmd is not None:
+        ins.write(cmd)
+    if hasattr(ins, 'read_raw'):
+        data = ins.read_raw()
+    else:
+        data = ins.read()
+    return parse_block(data, dtype)[0]
+
+class CoalescingWriter(object):
+    '''
+    Wrapper around a visa style instrument that collects SCPI commands
+    passed to write() and sends them joined with ';' in as few transfers
+    as possible, each at most <max_length> bytes. Commands that are not
+    common commands ('*...') or already absolute (':...') are prefixed with
+    ':', so every command is interpreted from the root of the command tree.
+
+    Buffered commands are sent by flush(), and before any other use of the
+    wrapped instrument (e.g. ask() or read()). Commands with binary blocks
+    are sent on their own. A query written with write() ends a message, so
+    that its reply is not merged with those of later queries.
+    '''
+
+    def __init__(self, ins, max_length=1024):
+        object.__setattr__(self, '_ins', ins)
+        object.__setattr__(self, '_max_length', max_length)
+        object.__setattr__(self, '_pending', [])
+        object.__setattr__(self, '_pending_length', 0)
+        object.__setattr__(self, '_stats', {'commands': 0, 'transfers': 0})
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self._ins, name)
+
+    def __setattr__(self, name, val):
+        self.flush()
+        setattr(self._ins, name, val)
+
+    def get_instrument(self):
+        '''Return the wrapped instrument.'''
+        return self._ins
+
+    def get_statistics(self):
+        '''Return number of commands written and transfers used.'''
+        return dict(self._stats)
+
+    def write(self, cmd):
+        cmd = cmd.rstrip('\r\n')
+        self._stats['commands'] += 1
+
+        if _BLOCK_RE.search(cmd) or len(cmd) >= self._max_length:
+            self.flush()
+            self._send(cmd)
+            return
+
+        # +2 for separator and ':'
+        if self._pending_length + len(cmd) + 2 > self._max_length:
+            self.flush()
+        if len(self._pending) > 0 and cmd[:1] not in (':', '*'):
+            cmd = ':' + cmd
+        self._pending.append(cmd)
+        object.__setattr__(self, '_pending_length',
+                self._pending_length + len(cmd) + 1)
+        if '?' in cmd:
+            self.flush()
+
+    def discard(self):
+        '''Drop buffered commands without sending them, return them.'''
+        pending = self._pending
+        object.__setattr__(self, '_pending', [])
+        object.__setattr__(self, '_pending_length', 0)
+        return pending
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        data = ';'.join(self._pending)
+        object.__setattr__(self, '_pending', [])
+        object.__setattr__(self, '_pending_length', 0)
+        self._send(data)
+
+    def _send(self, data):
+        self._stats['transfers'] += 1
+        self._ins.write(data)
+
 set_visa('pyvisa')
 
 class TcpIpInstrument:
     '''
     Class to mimic visa instrument for TCP/IP connected text-based devices.
+
+    Received data is kept in a buffer and split into replies at
+    <termchars>, so several queries can be sent at once (see ask_many).
+    Stale input is dropped before each ask, depending on <drain>:
+        'none': keep it; replies are returned in the order they arrive
+        'buffer': drop data that was already received (default)
+        'socket': also read and drop data waiting on the socket
+    After a read timed out the socket is always drained before the next
+    write, so a late reply is not taken for the reply to a new command.
     '''
 
-    def __init__(self, host, port, timeout=20, termchars='\n'):
+    DRAIN_POLICIES = ('none', 'buffer', 'socket')
+
+    # Received data before this offset in the buffer is dropped when the
+    # consumed part is larger than this.
+    COMPACT_SIZE = 65536
+
+    def __init__(self, host, port, timeout=20, termchars='\n',
+            drain='buffer'):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((host, port))
 
+        # Received data is self._buffer[self._start:]
+        self._buffer = bytearray()
+        self._start = 0
+        self._scanned = 0
+        self._dirty = False
+        self._pending_term = False
         self._termchars = termchars
         self._timeout = timeout
         self.set_timeout(timeout)
+        self.set_drain_policy(drain)
 
     def set_timeout(self, timeout):
         self._timeout = timeout
@@ -64,40 +255,193 @@ class TcpIpInstrument:
 
     def set_termchars(self, termchars):
         self._termchars = termchars
+        self._scanned = self._start
 
-    def clear(self):
-        rlist, wlist, xlist = select.select([self._socket], [], [], 0)
-        if len(rlist) == 0:
+    def set_drain_policy(self, drain):
+        if drain not in self.DRAIN_POLICIES:
+            raise ValueError('Unknown drain policy: %s' % drain)
+        self._drain = drain
+
+    def _recv(self, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('timed out')
+        self._socket.settimeout(remaining)
+        data = self._socket.recv(65536)
+        if len(data) == 0:
+            raise socket.error('Connection closed by instrument')
+        self._buffer.extend(data)
+
+    def _available(self):
+        return len(self._buffer) - self._start
+
+    def _take(self, n):
+        '''Remove <n> bytes from the buffer and return them as string.'''
+        ret = str(self._buffer[self._start:self._start + n])
+        self._start += n
+        if self._start >= self.COMPACT_SIZE:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._scanned = self._start
+        return ret
+
+    def _reset_buffer(self):
+        self._buffer = bytearray()
+        self._start = 0
+        self._scanned = 0
+        self._pending_term = False
+
+    def _skip_pending_term(self):
+        # Drop the termchars of a block reply that were not received
+        # yet when the block was returned.
+        if not self._pending_term or \
+                self._available() < len(self._termchars):
             return
-        ret = self.read()
+        self._pending_term = False
+        if self._buffer.startswith(self._termchars, self._start):
+            self._take(len(self._termchars))
+
+    def clear(self):
+        '''Drop buffered data and data waiting on the socket.'''
+        self._reset_buffer()
+        self._dirty = False
+        while True:
+            rlist, wlist, xlist = select.select([self._socket], [], [], 0)
+            if len(rlist) == 0:
+                return
+            if len(self._socket.recv(65536)) == 0:
+                return
+
+    def _drain_input(self):
+        if self._drain == 'socket':
+            self.clear()
+        elif self._drain == 'buffer':
+            self._reset_buffer()
 
     def write(self, data):
-        self.clear()
+        if self._dirty:
+            self.clear()
         if not data.endswith(self._termchars):
             data += self._termchars
-        self._socket.send(data)
+        self._socket.sendall(data)
+
+    def readline(self, timeout=None):
+        '''
+        Return the next reply, without termchars. Returns '' on timeout;
+        partially received data is kept, but dropped before the next
+        write.
+        '''
 
-    def read(self, timeout=None):
         if timeout is None:
             timeout = self._timeout
-        start = time()
+        deadline = time.time() + timeout
         try:
-            ans = ''
-            while len(ans) == 0 and (time() - start) < timeout and not ans.endswith(self._termchars):
-                ans2 = self._socket.recv(8192)
-                ans += ans2
-                if len(ans2) == 0:
-                    sleep(0.005)
+            while True:
+                self._skip_pending_term()
+                if not self._pending_term:
+                    idx = self._buffer.find(self._termchars, self._scanned)
+                    if idx >= 0:
+                        break
+                    self._scanned = max(self._start,
+                            len(self._buffer) - len(self._termchars) + 1)
+                self._recv(deadline)
         except socket.timeout, e:
             logging.warning('TCP/IP instrument read timed out')
+            self._dirty = True
             return ''
+        finally:
+            self._socket.settimeout(self._timeout)
 
-        if ans.endswith(self._termchars):
-            ans = ans[:-len(self._termchars)]
-        return ans
+        ret = self._take(idx - self._start)
+        self._take(len(self._termchars))
+        return ret
+
+    def read(self, timeout=None):
+        return self.readline(timeout)
+
+    def read_raw(self, nbytes=None, timeout=None):
+        '''
+        Return exactly <nbytes> bytes, without looking for termchars.
+
+        If <nbytes> is None, read one binary block reply ('#<n><length>'
+        optionally followed by termchars) into a preallocated bytearray,
+        which is returned including the header. Other replies are read as
+        with readline().
+        '''
+
+        if timeout is None:
+            timeout = self._timeout
+        deadline = time.time() + timeout
+        try:
+            if nbytes is None:
+                return self._read_block(deadline)
+
+            self._skip_pending_term()
+            while self._pending_term or self._available() < nbytes:
+                self._recv(deadline)
+                self._skip_pending_term()
+        except socket.timeout:
+            self._dirty = True
+            raise
+        finally:
+            self._socket.settimeout(self._timeout)
+
+        return self._take(nbytes)
+
+    def _read_block(self, deadline):
+        self._skip_pending_term()
+        while self._pending_term or self._available() == 0:
+            self._recv(deadline)
+            self._skip_pending_term()
+        if self._buffer[self._start] != ord('#'):
+            return self.readline(deadline - time.time())
+
+        while True:
+            hdr = parse_block_header(self._buffer, self._start)
+            if hdr is not None:
+                break
+            self._recv(deadline)
+        start, length = hdr
+        if length is None:
+            return self.readline(deadline - time.time())
+
+        total = start - self._start + length
+        ret = bytearray(total)
+        pos = min(total, self._available())
+        ret[:pos] = self._buffer[self._start:self._start + pos]
+        self._take(pos)
+
+        view = memoryview(ret)
+        while pos < total:
+            self._socket.settimeout(max(deadline - time.time(), 0.001))
+            n = self._socket.recv_into(view[pos:], total - pos)
+            if n == 0:
+                raise socket.error('Connection closed by instrument')
+            pos += n
+
+        # IEEE 488.2 allows a definite length block without terminator:
+        # only take termchars that are available now, drop the ones that
+        # arrive later before the next reply.
+        rlist, wlist, xlist = select.select([self._socket], [], [], 0)
+        if len(rlist) > 0:
+            self._recv(time.time() + self._timeout)
+        self._pending_term = True
+        self._skip_pending_term()
+
+        return ret
 
     def ask(self, data):
-        self.clear()
+        self._drain_input()
         self.write(data)
-        return self.read()
+        return self.readline()
 
+    def ask_many(self, cmds):
+        '''
+        Send queries <cmds> in one packet and return the list of replies.
+        '''
+
+        self._drain_input()
+        data = ''.join([c if c.endswith(self._termchars) \
+                else c + self._termchars for c in cmds])
+        self.write(data)
+        return [self.readline() for c in cmds]
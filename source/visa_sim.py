@@ -0,0 +1,461 @@
+# visa_sim.py, simulated VISA provider for testing without hardware
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Simulated VISA provider.
+
+Devices are simulated by 'responders' that interpret the SCPI commands
+written to them. Each write and read is delayed according to a latency
+model, so that bus scheduling and caching can be benchmarked without
+hardware.
+
+To use:
+    import visa_sim
+    visa_sim.add_device('GPIB::16', 'Keithley_2000',
+        latency=visa_sim.LatencyModel(write=1e-3, read=5e-3, jitter=1e-3))
+    qt.instruments.create('dmm', 'Keithley_2000', address='GPIB::16',
+        visa='sim')
+
+Addresses that were not added get a generic SCPI responder and the default
+latency model (see set_default_latency).
+'''
+
+import re
+import time
+import random
+import struct
+import logging
+
+class LatencyModel:
+    '''
+    Latency of simulated instrument I/O.
+
+    The delay for a transfer is the base delay for the direction ('write'
+    or 'read') plus per_byte times the number of bytes, plus a uniformly
+    distributed random jitter in [-jitter, jitter] (the total is never
+    negative). Extra delays for specific commands can be given as a list of
+    (regular expression, delay) tuples; these apply to the write of a
+    matching command, e.g. to simulate a slow measurement.
+    '''
+
+    def __init__(self, write=0.0, read=0.0, per_byte=0.0, jitter=0.0,
+            commands=None):
+        self.write = write
+        self.read = read
+        self.per_byte = per_byte
+        self.jitter = jitter
+        self.commands = []
+        if commands is not None:
+            for regex, delay in commands:
+                self.commands.append((re.compile(regex, re.I), delay))
+
+    def get_delay(self, direction, data):
+        if direction == 'write':
+            delay = self.write
+            for regex, extra in self.commands:
+                if regex.search(data):
+                    delay += extra
+        else:
+            delay = self.read
+
+        delay += self.per_byte * len(data)
+        if self.jitter > 0:
+            delay += random.uniform(-self.jitter, self.jitter)
+        return max(0, delay)
+
+    def wait(self, direction, data):
+        delay = self.get_delay(direction, data)
+        if delay > 0:
+            time.sleep(delay)
+
+class SCPIResponder:
+    '''
+    Generic simulated SCPI device.
+
+    Settings written as '<KEY> <value>' are stored and returned again by
+    the query '<KEY>?'. Queries with an argument ('<KEY>? <arg>') use the
+    key '<KEY> <arg>'. Unknown queries return '0'. Sub-classes can add
+    handlers for specific queries in QUERIES, a list of (regular
+    expression, method name) tuples; the method is called with the match
+    object and should return the reply.
+    '''
+
+    IDN = 'QTLab,Simulated SCPI device,0,1.0'
+    DEFAULTS = {}
+    QUERIES = []
+
+    def __init__(self):
+        self._queries = []
+        for regex, fname in self.QUERIES:
+            self._queries.append((re.compile(regex, re.I | re.S),
+                getattr(self, fname)))
+        self.reset()
+
+    def reset(self):
+        self._state = dict(self.DEFAULTS)
+        self._errors = []
+
+    def split(self, data):
+        '''Split a write into separate commands.'''
+        # Do not split binary block data
+        if '#' in data:
+            return [data]
+        return data.split(';')
+
+    def normalize(self, key):
+        return key.strip().lstrip(':').upper()
+
+    def write(self, data):
+        '''
+        Handle written data, return reply (string) or None.
+        '''
+
+        replies = []
+        for cmd in self.split(data):
+            cmd = cmd.strip()
+            if cmd == '':
+                continue
+            ret = self.command(cmd)
+            if ret is not None:
+                replies.append(str(ret))
+
+        if len(replies) == 0:
+            return None
+        return ';'.join(replies)
+
+    def command(self, cmd):
+        for regex, func in self._queries:
+            m = regex.match(cmd)
+            if m:
+                return func(m)
+
+        ucmd = cmd.upper()
+        if ucmd == '*IDN?':
+            return self.IDN
+        elif ucmd == '*RST':
+            self.reset()
+            return None
+        elif ucmd == '*CLS':
+            self._errors = []
+            return None
+        elif ucmd == '*OPC?':
+            return '1'
+        elif ucmd.lstrip(':') in ('SYST:ERR?', 'SYST:ERR:NEXT?'):
+            if len(self._errors) > 0:
+                return self._errors.pop(0)
+            return '0,"No error"'
+
+        if '?' in cmd:
+            key, arg = cmd.split('?', 1)
+            key = self.normalize(key)
+            if arg.strip() != '':
+                key = '%s %s' % (key, arg.strip())
+            return self.query(key)
+
+        parts = cmd.split(None, 1)
+        if len(parts) == 1:
+            self.set(self.normalize(parts[0]), '')
+        else:
+            self.set(self.normalize(parts[0]), parts[1].strip())
+        return None
+
+    def query(self, key):
+        return self._state.get(key, '0')
+
+    def set(self, key, val):
+        self._state[key] = val
+
+class Keithley2000Responder(SCPIResponder):
+    '''Keithley 2000/2700 multimeter.'''
+
+    IDN = 'KEITHLEY INSTRUMENTS INC.,MODEL 2000,0,SIM'
+    DEFAULTS = {
+        'FUNC': '"VOLT:DC"',
+        'INIT:CONT': '1',
+        'TRIG:COUN': '1',
+        'TRIG:SOUR': 'IMM',
+        'TRIG:DEL': '0',
+        'TRIG:TIM': '0.1',
+        'DISP:ENAB': '1',
+        'SYST:AZER:STAT': '1',
+    }
+    QUERIES = [
+        (r'^:?(READ|FETCH|DATA|DATA:FRESH)\?$', '_reading'),
+        (r'^:?[A-Z:]+:(RANG|NPLC|APER|DIG)\?$', '_func_setting'),
+    ]
+    _FUNC_DEFAULTS = {
+        'RANG': '10',
+        'NPLC': '1',
+        'APER': '0.02',
+        'DIG': '6',
+    }
+
+    def _reading(self, m):
+        return '%+.7E' % random.gauss(1.0, 1e-4)
+
+    def _func_setting(self, m):
+        key = self.normalize(m.group(0)[:-1])
+        return self._state.get(key, self._FUNC_DEFAULTS[m.group(1).upper()])
+
+class SR830Responder(SCPIResponder):
+    '''Stanford Research SR830 lock-in amplifier.'''
+
+    IDN = 'Stanford_Research_Systems,SR830,s/n00000,ver1.07'
+    DEFAULTS = {
+        'FREQ': '1.000e+03',
+        'SLVL': '1.000e+00',
+        'PHAS': '0.000e+00',
+        'SENS': '22',
+        'OFLT': '10',
+        'HARM': '1',
+        'RMOD': '1',
+        'RSLP': '0',
+        'ISRC': '0',
+        'ICPL': '0',
+        'IGND': '0',
+        'ILIN': '0',
+        'SYNC': '0',
+        'FMOD': '1',
+        'OFSL': '0',
+    }
+    QUERIES = [
+        (r'^OUTP\?\s*(\d)$', '_output'),
+        (r'^OAUX\?\s*(\d)$', '_aux_in'),
+        (r'^LIAS\?\s*(\d)$', '_status'),
+        (r'^AUXV\s*(\d)\s*,\s*(\S+)$', '_set_aux_out'),
+        (r'^AUXV\?\s*(\d)$', '_aux_out'),
+    ]
+
+    def _output(self, m):
+        x, y = random.gauss(1e-3, 1e-6), random.gauss(0, 1e-6)
+        if m.group(1) == '1':
+            val = x
+        elif m.group(1) == '2':
+            val = y
+        elif m.group(1) == '3':
+            val = (x**2 + y**2) ** 0.5
+        else:
+            val = 0.0
+        return '%e' % val
+
+    def _aux_in(self, m):
+        return '%.3f' % random.gauss(0, 1e-3)
+
+    def _status(self, m):
+        return '0'
+
+    def _set_aux_out(self, m):
+        self._state['AUXV %s' % m.group(1)] = m.group(2)
+
+    def _aux_out(self, m):
+        return self._state.get('AUXV %s' % m.group(1), '0.000')
+
+class HP8753CResponder(SCPIResponder):
+    '''
+    HP 8753C network analyzer. Uses HP-style commands without separating
+    spaces (e.g. 'STAR1.0e6HZ;') and returns binary FORM2 traces.
+    '''
+
+    IDN = 'HEWLETT PACKARD,8753C,0,4.13'
+    DEFAULTS = {
+        'STAR': '3.000000E+05',
+        'STOP': '3.000000E+09',
+        'POIN': '201',
+        'POWE': '0.000000E+00',
+        'IFBW': '3000',
+    }
+    _SETRE = re.compile(r'^([A-Z]+?)([-+]?[\d.]+(?:E[-+]?\d+)?)(HZ|GHZ)?$',
+            re.I)
+
+    def reset(self):
+        SCPIResponder.reset(self)
+        self._form = 4
+
+    def command(self, cmd):
+        ucmd = cmd.upper()
+        if ucmd == 'OUTPFORM':
+            return self._trace()
+        elif ucmd.startswith('FORM') and ucmd[4:].isdigit():
+            self._form = int(ucmd[4:])
+            return None
+        elif ucmd.endswith('?'):
+            return self.query(ucmd[:-1])
+
+        m = self._SETRE.match(cmd)
+        if m:
+            self.set(m.group(1).upper(), m.group(2))
+            return None
+
+        return SCPIResponder.command(self, cmd)
+
+    def split(self, data):
+        return data.split(';')
+
+    def _trace(self):
+        npoints = int(float(self._state['POIN']))
+        data = ''.join([struct.pack('>ff', random.gauss(-20, 0.1), 0.0) \
+                for i in range(npoints)])
+        return '#A' + struct.pack('>H', len(data)) + data
+
+class AWG5014Responder(SCPIResponder):
+    '''Tektronix AWG5014 arbitrary waveform generator.'''
+
+    IDN = 'TEKTRONIX,AWG5014,B000000,SCPI:99.0 FW:3.1.141.647'
+    DEFAULTS = {
+        'AWGC:RMOD': 'CONT',
+        'SOUR:FREQ': '1.0000000000E+09',
+        'TRIG:LEV': '1.000',
+        'TRIG:IMP': '1.0E+3',
+    }
+    QUERIES = [
+        (r'^MMEM:DATA\s+"([^"]*)",(.*)$', '_store_file'),
+        (r'^MMEM:DATA\?\s+"([^"]*)"$', '_read_file'),
+        (r'^MMEM:CAT\?.*$', '_catalog'),
+        (r'^WLIST:SIZE\?$', '_wlist_size'),
+        (r'^WLIS:WAV:DEL\s+ALL$', '_wlist_clear'),
+    ]
+
+    def reset(self):
+        SCPIResponder.reset(self)
+        self._files = {}
+
+    def _store_file(self, m):
+        self._files[m.group(1)] = m.group(2)
+
+    def _read_file(self, m):
+        return self._files.get(m.group(1), '')
+
+    def _catalog(self, m):
+        entries = ['"%s",,%d' % (name, len(data)) \
+                for name, data in self._files.iteritems()]
+        return '0,0,' + ','.join(entries)
+
+    def _wlist_size(self, m):
+        return '25'
+
+    def _wlist_clear(self, m):
+        return None
+
+RESPONDERS = {
+    'generic': SCPIResponder,
+    'Keithley_2000': Keithley2000Responder,
+    'Keithley_2700': Keithley2000Responder,
+    'SR830': SR830Responder,
+    'HP_8753C': HP8753CResponder,
+    'Tektronix_AWG5014': AWG5014Responder,
+}
+
+_devices = {}
+_default_latency = LatencyModel()
+
+def set_default_latency(latency):
+    '''Set latency model for devices added without one.'''
+    global _default_latency
+    _default_latency = latency
+
+def add_device(address, responder='generic', latency=None):
+    '''
+    Simulate a device at <address>.
+
+    Input:
+        address (string): VISA address, e.g. 'GPIB::16'
+        responder (string or SCPIResponder instance): device type, one of
+            the keys in RESPONDERS, or a responder object
+        latency (LatencyModel): I/O latency, default latency if None
+    '''
+
+    if type(responder) is str:
+        if responder not in RESPONDERS:
+            raise ValueError('Unknown simulated device type: %s' % responder)
+        responder = RESPONDERS[responder]()
+
+    _devices[address] = (responder, latency)
+    return responder
+
+def remove_device(address):
+    if address in _devices:
+        del _devices[address]
+
+def get_device(address):
+    '''Return responder for <address>, create a generic one if needed.'''
+    if address not in _devices:
+        add_device(address)
+    return _devices[address][0]
+
+class instrument(object):
+    '''
+    Visa style interface to a simulated device.
+    '''
+
+    def __init__(self, address, **kwargs):
+        self.address = address
+        self.timeout = kwargs.get('timeout', 5)
+        self.term_chars = kwargs.get('term_chars', '\n')
+        self.send_end = kwargs.get('send_end', True)
+        self.delay = kwargs.get('delay', 0)
+        self.values_format = kwargs.get('values_format', 'ascii')
+
+        self._responder = get_device(address)
+        self._output = []
+
+    def _get_latency(self):
+        latency = _devices[self.address][1]
+        if latency is None:
+            latency = _default_latency
+        return latency
+
+    def write(self, cmd):
+        self._get_latency().wait('write', cmd)
+        try:
+            reply = self._responder.write(cmd)
+        except Exception, e:
+            logging.warning('Simulated device %s failed on %r: %s',
+                    self.address, cmd, str(e))
+            reply = None
+        if reply is not None:
+            self._output.append(reply)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def read(self):
+        if len(self._output) == 0:
+            time.sleep(self.timeout)
+            raise IOError('Timeout reading from simulated device %s' % \
+                    self.address)
+
+        reply = self._output.pop(0)
+        self._get_latency().wait('read', reply)
+        return reply
+
+    def read_values(self, format=None):
+        return [float(v) for v in self.read().split(',')]
+
+    def ask(self, cmd):
+        self.write(cmd)
+        return self.read()
+
+    def ask_for_values(self, cmd, format=None):
+        self.write(cmd)
+        return self.read_values(format)
+
+    def clear(self):
+        self._output = []
+
+    def trigger(self):
+        self._responder.write('*TRG')
+
+    def close(self):
+        pass
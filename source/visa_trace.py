@@ -0,0 +1,331 @@
+# visa_trace.py, record and replay instrument I/O
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Record and replay instrument I/O.
+
+Recording: call start_recording(<filename>) before creating instruments.
+All objects created through visa.instrument (pyvisa, prologix_ethernet,
+sim) are then wrapped and every write and read is stored, with timestamp
+and duration, in a compact binary trace. Other transport objects, such as
+visa.TcpIpInstrument, can be wrapped explicitly with record(obj, name).
+Call stop_recording() to close the trace.
+
+Replay: call load_trace(<filename>, scale=1.0) and create the instruments
+with visa='replay'. Reads return the recorded replies; each transfer takes
+the recorded time multiplied by 'scale' (0 for no delay).
+
+Trace format: the header 'QTTR' followed by a version byte, then records
+consisting of a header (op, channel, time, duration, length; see
+_RECORD) and <length> bytes of payload. Op 'o' opens a channel, payload
+is the address; 'w' is a write, 'r' a read, 'v' the reply of an
+ask_for_values call (comma separated values) and 'e' a failed transfer
+(payload is the error message).
+'''
+
+import struct
+import threading
+import time
+import logging
+
+_MAGIC = 'QTTR'
+_VERSION = 1
+_RECORD = struct.Struct('<cHdfI')
+
+class TraceWriter:
+    '''
+    Write I/O records to a trace file. Can be used from several threads.
+    '''
+
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._file.write(_MAGIC + chr(_VERSION))
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._nchannels = 0
+
+    def open_channel(self, address):
+        self._lock.acquire()
+        channel = self._nchannels
+        self._nchannels += 1
+        self._lock.release()
+
+        self.add_record('o', channel, self._start, 0, str(address))
+        return channel
+
+    def add_record(self, op, channel, start, duration, data):
+        rec = _RECORD.pack(op, channel, start - self._start, duration,
+                len(data))
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.write(rec)
+                self._file.write(data)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+def read_trace(filename):
+    '''
+    Read trace file <filename>.
+
+    Output: list of (address, records) tuples, one per channel, where
+        records is a list of (op, time, duration, data) tuples.
+    '''
+
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+
+    if data[:4] != _MAGIC:
+        raise ValueError('%s is not a trace file' % filename)
+    if ord(data[4]) != _VERSION:
+        raise ValueError('Unsupported trace version %d' % ord(data[4]))
+
+    channels = {}
+    pos = 5
+    while pos + _RECORD.size <= len(data):
+        op, channel, t, duration, length = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        payload = data[pos:pos + length]
+        pos += length
+
+        if op == 'o':
+            channels[channel] = (payload, [])
+        elif channel in channels:
+            channels[channel][1].append((op, t, duration, payload))
+
+    keys = channels.keys()
+    keys.sort()
+    return [channels[k] for k in keys]
+
+class RecordingInstrument(object):
+    '''
+    Wrapper around a visa style instrument object that records all I/O.
+    Other attributes are passed on to the wrapped object.
+    '''
+
+    def __init__(self, ins, address, writer):
+        object.__setattr__(self, '_ins', ins)
+        object.__setattr__(self, '_writer', writer)
+        object.__setattr__(self, '_channel', writer.open_channel(address))
+
+    def __getattr__(self, name):
+        return getattr(self._ins, name)
+
+    def __setattr__(self, name, val):
+        setattr(self._ins, name, val)
+
+    def _call(self, op, func, *args, **kwargs):
+        start = time.time()
+        try:
+            ret = func(*args, **kwargs)
+        except Exception, e:
+            self._writer.add_record('e', self._channel, start,
+                    time.time() - start, str(e))
+            raise
+        duration = time.time() - start
+
+        if op == 'w':
+            data = args[0]
+        elif op == 'v':
+            data = ','.join([repr(v) for v in ret])
+        else:
+            data = ret
+        self._writer.add_record(op, self._channel, start, duration, data)
+        return ret
+
+    def write(self, cmd):
+        return self._call('w', self._ins.write, cmd)
+
+    def read(self, *args, **kwargs):
+        return self._call('r', self._ins.read, *args, **kwargs)
+
+    def readline(self, *args, **kwargs):
+        return self._call('r', self._ins.readline, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._call('r', getattr(self._ins, 'read_raw', self._ins.read),
+                *args, **kwargs)
+
+    def ask_many(self, cmds):
+        '''
+        Stored as a write for each command followed by a read for each
+        reply; the duration is divided over the reads.
+        '''
+
+        start = time.time()
+        try:
+            replies = self._ins.ask_many(cmds)
+        except Exception, e:
+            self._writer.add_record('e', self._channel, start,
+                    time.time() - start, str(e))
+            raise
+        duration = time.time() - start
+
+        for cmd in cmds:
+            self._writer.add_record('w', self._channel, start, 0, cmd)
+        for reply in replies:
+            self._writer.add_record('r', self._channel, start,
+                    duration / len(replies), reply)
+        return replies
+
+    def ask(self, cmd):
+        self.write(cmd)
+        return self.read()
+
+    def read_values(self, format=None):
+        return self._call('v', self._ins.read_values, format)
+
+    def ask_for_values(self, cmd, format=None):
+        self.write(cmd)
+        return self.read_values(format)
+
+_writer = None
+
+def start_recording(filename):
+    '''Record I/O of instruments created from now on to <filename>.'''
+    global _writer
+    stop_recording()
+    _writer = TraceWriter(filename)
+
+def stop_recording():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+def is_recording():
+    return _writer is not None
+
+def record(ins, address):
+    '''
+    Return a recording wrapper for instrument object <ins> if recording,
+    otherwise <ins> itself.
+    '''
+    if _writer is None:
+        return ins
+    return RecordingInstrument(ins, address, _writer)
+
+def recording_factory(factory):
+    '''
+    Wrap visa instrument constructor <factory> so that created objects are
+    recorded.
+    '''
+
+    def create(address, *args, **kwargs):
+        return record(factory(address, *args, **kwargs), address)
+    return create
+
+_channels = []
+_scale = 1.0
+
+def load_trace(filename, scale=1.0):
+    '''
+    Load trace <filename> for replay. Transfers take the recorded time
+    multiplied by <scale>.
+    '''
+
+    global _channels, _scale
+    _channels = read_trace(filename)
+    _scale = scale
+
+def set_scale(scale):
+    global _scale
+    _scale = scale
+
+class instrument(object):
+    '''
+    Visa style instrument that replays a recorded trace. Instruments are
+    matched to the recorded channels by address, in order of creation.
+    '''
+
+    def __init__(self, address, **kwargs):
+        self.address = address
+        self.timeout = kwargs.get('timeout', 5)
+        self.term_chars = kwargs.get('term_chars', None)
+
+        self._records = None
+        for i, (addr, records) in enumerate(_channels):
+            if addr == str(address):
+                self._records = records
+                del _channels[i]
+                break
+
+        if self._records is None:
+            raise ValueError('No recorded I/O for address %s' % address)
+
+    def _next(self, op, data=None):
+        if len(self._records) == 0:
+            raise IOError('End of trace for %s' % self.address)
+
+        rop, t, duration, payload = self._records.pop(0)
+        if _scale > 0 and duration > 0:
+            time.sleep(duration * _scale)
+
+        if rop == 'e':
+            raise IOError('Recorded error: %s' % payload)
+        if rop != op:
+            logging.warning('Replay of %s out of sync: expected %r, got %r',
+                    self.address, rop, op)
+        elif op == 'w' and payload != data:
+            logging.warning('Replay of %s: recorded write %r, got %r',
+                    self.address, payload, data)
+
+        return payload
+
+    def write(self, cmd):
+        self._next('w', cmd)
+
+    def read(self, *args, **kwargs):
+        return self._next('r')
+
+    def readline(self, *args, **kwargs):
+        return self._next('r')
+
+    def read_raw(self, *args, **kwargs):
+        return self._next('r')
+
+    def ask_many(self, cmds):
+        for cmd in cmds:
+            self.write(cmd)
+        return [self.readline() for cmd in cmds]
+
+    def ask(self, cmd):
+        self.write(cmd)
+        return self.read()
+
+    def read_values(self, format=None):
+        data = self._next('v')
+        if data == '':
+            return []
+        return [float(v) for v in data.split(',')]
+
+    def ask_for_values(self, cmd, format=None):
+        self.write(cmd)
+        return self.read_values(format)
+
+    def clear(self):
+        pass
+
+    def trigger(self):
+        pass
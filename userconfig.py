@@ -27,6 +27,9 @@ config['instrument_server'] = False
 ## This sets a default location for data-storage
 #config['datadir'] = 'd:/data'
 
+## Directory to store values of persistent instrument parameters in
+#config['persistdir'] = 'd:/qtlab_persist'
+
 ## This sets a default directory for qtlab to start in
 #config['startdir'] = 'd:/scripts'
 